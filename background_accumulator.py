@@ -0,0 +1,199 @@
+import heapq
+import numpy as np
+
+# local imports
+from result_store import templateRows
+
+# The accumulator is a dictionary of summaries that can be updated one segment
+# at a time and merged between workers. Its size is fixed when it is
+# initialised: the maximum log likelihood of each segment goes into a
+# histogram, and only the largest maxima are kept exactly, which are the ones
+# that matter for the significance of a foreground candidate.
+
+
+def initAccumulator(scoreRange=(-2000, 0), nBins=2000, topK=1000, maxCandidates=100):
+  '''
+  Creates an empty accumulator.
+
+  Optional:   scoreRange:     range of log likelihoods covered by histograms,
+                              values outside are counted as under- or overflow
+              nBins:          number of histogram bins
+              topK:           number of largest segment maxima kept exactly
+              maxCandidates:  largest number of signal candidates counted
+                              separately, more candidates share the last bin
+
+  Returns:    acc:            dictionary of accumulated summaries
+  '''
+
+  return {'binEdges': np.linspace(scoreRange[0], scoreRange[1], nBins+1),
+          'scoreCounts': np.zeros(nBins + 2, dtype=np.int64),    # all templates
+          'maxCounts': np.zeros(nBins + 2, dtype=np.int64),      # segment maxima
+          'topMaxima': [],                                       # min-heap
+          'topK': topK,
+          'candidateCounts': np.zeros(maxCandidates + 1, dtype=np.int64),
+          'segments': 0,
+          'templates': 0,
+          'signalTemplates': 0,
+          'liveTime': 0.0}
+
+
+def binIndices(acc, values):
+  '''
+  Histogram bin of each value, with 0 for underflow and nBins+1 for overflow.
+  '''
+
+  return np.searchsorted(acc['binEdges'], values, side='right')
+
+
+def updateAccumulator(acc, logLikelihoods, maxLogLikelihood, liveTime=0.0):
+  '''
+  Adds the results of one segment to the accumulator.
+
+  Params:     acc:                accumulator from initAccumulator
+              logLikelihoods:     array of log likelihoods returned by
+                                  likelihood
+              maxLogLikelihood:   maximum log likelihood of the segment
+
+  Optional:   liveTime:           duration of the segment in seconds, needed
+                                  for false alarm rates
+
+  Returns:    acc:                updated accumulator
+  '''
+
+  L = templateRows(logLikelihoods)
+
+  # histogram of all template scores
+  acc['scoreCounts'] += np.bincount(binIndices(acc, L[:, 0]), minlength=len(acc['scoreCounts']))
+
+  # signal candidate counts, clipped to the last bin
+  candidates = np.minimum(L[:, 4].astype(int), len(acc['candidateCounts']) - 1)
+  acc['candidateCounts'] += np.bincount(candidates, minlength=len(acc['candidateCounts']))
+  acc['signalTemplates'] += int(L[:, 5].sum())
+  acc['templates'] += len(L)
+
+  # segment maximum, kept exactly if among the largest
+  acc['maxCounts'][binIndices(acc, maxLogLikelihood)] += 1
+  if len(acc['topMaxima']) < acc['topK']:
+    heapq.heappush(acc['topMaxima'], float(maxLogLikelihood))
+  else:
+    heapq.heappushpop(acc['topMaxima'], float(maxLogLikelihood))
+
+  acc['segments'] += 1
+  acc['liveTime'] += liveTime
+
+  return acc
+
+
+def mergeAccumulators(*accs):
+  '''
+  Combines accumulators filled independently, e.g. by parallel workers.
+
+  Params:   accs:   accumulators with identical binning
+  Returns:  acc:    merged accumulator
+  '''
+
+  acc = {k: v.copy() if isinstance(v, (np.ndarray, list)) else v for k, v in accs[0].items()}
+
+  for other in accs[1:]:
+    if not np.array_equal(acc['binEdges'], other['binEdges']) or len(acc['candidateCounts']) != len(other['candidateCounts']):
+      raise ValueError('Accumulators must have identical binning to be merged')
+
+    for key in ['scoreCounts', 'maxCounts', 'candidateCounts']:
+      acc[key] += other[key]
+    for key in ['segments', 'templates', 'signalTemplates', 'liveTime']:
+      acc[key] += other[key]
+
+    # keep the largest maxima of both
+    acc['topMaxima'] = heapq.nlargest(acc['topK'], acc['topMaxima'] + other['topMaxima'])
+    heapq.heapify(acc['topMaxima'])
+
+  return acc
+
+
+def countAbove(acc, counts, value):
+  '''
+  Estimates the number of entries of a histogram at or above a value,
+  interpolating linearly within the bin containing it.
+  '''
+
+  edges = acc['binEdges']
+  k = int(binIndices(acc, value))
+
+  # entries in bins fully above the value, including overflow
+  above = counts[k+1:].sum()
+
+  # fraction of the bin containing the value; under- and overflow bins are
+  # taken to lie entirely above the value
+  if 1 <= k <= len(edges) - 1:
+    above += counts[k] * (edges[k] - value) / (edges[k] - edges[k-1])
+  else:
+    above += counts[k]
+
+  return float(above)
+
+
+def significance(acc, fgMaxL):
+  '''
+  Running significance of a foreground maximum log likelihood against the
+  accumulated background.
+
+  Params:   acc:             accumulator from initAccumulator
+            fgMaxL:          foreground maximum log likelihood
+
+  Returns:  result:          dictionary with
+                             louder:  number of background segments with a
+                                      maximum at least as large
+                             exact:   True if louder is an exact count, which
+                                      holds unless fgMaxL is below every kept
+                                      maximum
+                             pValue:  probability of a background segment
+                                      being at least as loud
+                             falseAlarmRate:  louder segments per second of
+                                      live time, None without live time
+                             templateFraction:  fraction of background
+                                      templates scoring at least fgMaxL
+  '''
+
+  top = acc['topMaxima']
+
+  # count exactly while the foreground is above the smallest kept maximum
+  if len(top) == acc['segments'] or (top and fgMaxL > min(top)):
+    louder = sum(1 for m in top if m >= fgMaxL)
+    exact = True
+  else:
+    louder = countAbove(acc, acc['maxCounts'], fgMaxL)
+    exact = False
+
+  n = acc['segments']
+
+  return {'louder': louder,
+          'exact': exact,
+          'pValue': (louder + 1) / (n + 1),
+          'falseAlarmRate': louder / acc['liveTime'] if acc['liveTime'] > 0 else None,
+          'templateFraction': countAbove(acc, acc['scoreCounts'], fgMaxL) / acc['templates'] if acc['templates'] else None}
+
+
+def saveAccumulator(path, acc):
+  '''
+  Writes an accumulator to a .npz file.
+  '''
+
+  np.savez(path, **{k: np.asarray(v) for k, v in acc.items()})
+
+
+def loadAccumulator(path):
+  '''
+  Reads an accumulator written by saveAccumulator.
+  '''
+
+  with np.load(path) as data:
+    acc = {k: data[k] for k in data.files}
+
+  # restore scalars and the heap of largest maxima
+  for key in ['topK', 'segments', 'templates', 'signalTemplates']:
+    acc[key] = int(acc[key])
+  acc['liveTime'] = float(acc['liveTime'])
+  acc['topMaxima'] = [float(m) for m in acc['topMaxima']]
+  heapq.heapify(acc['topMaxima'])
+
+  return acc
@@ -0,0 +1,446 @@
+import math
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# local imports
+from load_files import numberedSegments
+from coordinate_conversions import solarSystemBarycentre, skyCoordinates, greatCircleDistances, angularMidpoints
+from time_functions import subsequenceTable, firstPartners
+from trigger_search import nearestTriggers
+from fast_search import segmentArrays, logCombinations, startLogLikelihood, resultRows
+
+# Many small segments are searched together. Their trigger arrays are stacked
+# one segment after the other, with offsets marking where each segment
+# starts, and every step runs once over the whole batch:
+#   preparation:     one barycentre conversion for all segments
+#   pairs:           all pairs of all segments, with one sky check
+#   templates:       time locations of every pair and subsequence generated
+#                    as arrays instead of one timeLocations call per pair
+#   scoring:         one Gaussian evaluation for all time locations
+# Results are split by segment at the end and are the same as those of
+# likelihoodFast on each segment.
+
+# estimated number of lattice points (rows times padded row length) turned
+# into templates at a time
+POINTS_PER_CHUNK = 2000000
+
+
+def prepareBatch(segments, verbose=False):
+  '''
+  Prepares many segments as prepareSegment does, with a single barycentre
+  conversion for all of them.
+
+  Params:     segments:     list of dataframes
+
+  Optional:   verbose:      boolean, prints number of triggers, False by default
+
+  Returns:    prepared:     list of prepared dataframes
+  '''
+
+  lengths = [len(df) for df in segments]
+  data = solarSystemBarycentre(pd.concat(segments, ignore_index=True))
+  data = skyCoordinates(data)
+  if verbose == True:
+    print('Triggers in batch:', len(data))
+
+  # split again and sort each segment by time
+  starts = np.cumsum([0] + lengths)
+  return [data.iloc[a:b].sort_values(by='baryTime', ignore_index=True) for a, b in zip(starts[:-1], starts[1:])]
+
+
+def stackSegments(arrays):
+  '''
+  Stacks trigger arrays of several segments.
+
+  Params:   arrays:     list of dictionaries of trigger arrays
+  Returns:  stacked:    dictionary of stacked trigger arrays
+            offsets:    index of the first trigger of each segment, and the
+                        total number of triggers at the end
+  '''
+
+  offsets = np.cumsum([0] + [len(a['baryTime']) for a in arrays]).astype(int)
+  stacked = {key: np.concatenate([a[key] for a in arrays] + [np.zeros(0)]) for key in ['baryTime', 'lat0', 'long0']}
+
+  return stacked, offsets
+
+
+def batchPairs(stacked, offsets, distanceWindow, minSeparations):
+  '''
+  Lists the trigger pairs of all segments that are far enough apart in time
+  and pass the sky check, in the order likelihood visits them.
+
+  Params:   stacked:          stacked trigger arrays
+            offsets:          segment offsets from stackSegments
+            distanceWindow:   allowed distance uncertainty window
+            minSeparations:   minDelta times the shortest subsequence sum, one
+                              per segment
+
+  Returns:  pairI, pairJ:     stacked trigger numbers of each pair
+            pairSegment:      segment of each pair
+  '''
+
+  times = stacked['baryTime']
+  pairI, pairJ, pairSegment = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+
+  for s, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+    i, j = np.triu_indices(stop - start, 1)
+
+    # pairs must be at least minSeparation apart to produce a template
+    partners = firstPartners(times[start:stop], minSeparations[s])
+    keep = j >= partners[i]
+    pairI.append(i[keep] + start)
+    pairJ.append(j[keep] + start)
+    pairSegment.append(np.full(np.count_nonzero(keep), s))
+
+  pairI, pairJ, pairSegment = np.concatenate(pairI), np.concatenate(pairJ), np.concatenate(pairSegment)
+
+  # one sky check for the whole batch
+  keep = greatCircleDistances(stacked['lat0'][pairI], stacked['long0'][pairI],
+                              stacked['lat0'][pairJ], stacked['long0'][pairJ]) <= distanceWindow
+
+  return pairI[keep], pairJ[keep], pairSegment[keep]
+
+
+def sequenceSteps(terms, rowDelta, rowLocs, start, sign):
+  '''
+  Times reached by adding (sign 1) or subtracting (sign -1) sequence steps
+  one at a time from a start time, as in locForward and locBackward.
+
+  Params:   terms:      array of the sequence terms of one cycle
+            rowDelta:   sequence unit of each row
+            rowLocs:    array of term indices of each step, one row per
+                        combination
+            start:      start time of each row
+
+  Returns:  array of times after each step
+  '''
+
+  # cumulative sums add steps in order, so times match the loops exactly
+  steps = rowDelta[:, None] * terms[rowLocs]
+  return np.cumsum(np.hstack([start[:, None], sign * steps]), axis=1)[:, 1:]
+
+
+def latticeChunks(estimates, budget=POINTS_PER_CHUNK):
+  '''
+  Splits combinations into chunks of similar lattice length, so padding every
+  row to the longest row of its chunk stays within the point budget.
+
+  Params:     estimates:    estimated number of lattice points of each
+                            combination
+
+  Optional:   budget:       maximum rows times longest estimate of a chunk,
+                            POINTS_PER_CHUNK by default
+
+  Returns:    chunks:       list of combination numbers of each chunk, at
+                            least one combination per chunk
+  '''
+
+  order = np.argsort(estimates, kind='stable')
+  sortedEstimates = estimates[order]
+  chunks = []
+  start = 0
+  while start < len(order):
+    # estimates are sorted, so the last row of a chunk is its longest, and
+    # only rows up to budget over the first estimate can fit
+    rows = int(min(budget // max(sortedEstimates[start], 1), len(order) - start))
+    fits = np.arange(1, rows + 1) * sortedEstimates[start:start + rows] <= budget
+    stop = start + max(int(np.count_nonzero(fits)), 1)
+    chunks.append(order[start:stop])
+    start = stop
+
+  return chunks
+
+
+def latticeTemplates(t1, t2, deltas, loc1, loc2, minTimes, maxTimes, terms, timeWindow, maxLength=None):
+  '''
+  Generates the time locations and windows of many (pair, subsequence)
+  combinations at once, as timeLocations does for each of them.
+
+  Params:     t1, t2:          times of first and second trigger
+              deltas:          sequence unit of each combination
+              loc1, loc2:      sequence locations i and j of the subsequence
+              minTimes:        minimum time of the segment of each combination
+              maxTimes:        maximum time of the segment of each combination
+              terms:           array of the sequence terms of one cycle
+              timeWindow:      allowed time uncertainty
+
+  Optional:   maxLength:       maximum number of time locations outside the
+                               trigger pair, no limit by default
+
+  Returns:    lengths:         number of time locations of each combination
+              pointTime:       time locations of all combinations, in order
+              pointWindow:     window of each time location
+  '''
+
+  m = len(terms)
+  n = len(deltas)
+  if n == 0:
+    return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+
+  # backward locations, nearest first; more steps are taken until every row
+  # has left the segment
+  nBackward = int(np.max(np.ceil((t1 - minTimes) / (deltas * terms.min())))) + 1
+  while True:
+    k = np.arange(nBackward)
+    backward = sequenceSteps(terms, deltas, (loc1[:, None] - 2 - k) % m, t1, -1)
+    validBackward = backward > minTimes[:, None]
+    if not validBackward[:, -1].any():
+      break
+    nBackward *= 2
+
+  # forward locations
+  nForward = int(np.max(np.ceil((maxTimes - t2) / (deltas * terms.min())))) + 1
+  while True:
+    k = np.arange(nForward)
+    forward = sequenceSteps(terms, deltas, (loc2[:, None] + k) % m, t2, 1)
+    validForward = forward < maxTimes[:, None]
+    if not validForward[:, -1].any():
+      break
+    nForward *= 2
+
+  # locations between the pair
+  k = np.arange(max(m - 1, 1))
+  middle = sequenceSteps(terms, deltas, np.minimum(loc1[:, None] - 1 + k, m - 1), t1, 1)
+  validMiddle = k < (loc2 - loc1)[:, None]
+
+  # keep the locations outside the pair closest to it, backward ones first on
+  # equal distances as in capLength
+  if maxLength is not None:
+    countBackward, countForward = validBackward.sum(axis=1), validForward.sum(axis=1)
+    distances = np.hstack([np.where(validBackward, t1[:, None] - backward, np.inf),
+                           np.where(validForward, forward - t2[:, None], np.inf)])
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :maxLength]
+    keptBackward = np.count_nonzero(nearest < nBackward, axis=1)
+
+    over = countBackward + countForward > maxLength
+    countBackward = np.where(over, keptBackward, countBackward)
+    countForward = np.where(over, maxLength - keptBackward, countForward)
+    validBackward &= np.arange(nBackward) < countBackward[:, None]
+    validForward &= np.arange(nForward) < countForward[:, None]
+
+  # chronological order within each combination
+  times = np.hstack([backward[:, ::-1], middle, forward])
+  valid = np.hstack([validBackward[:, ::-1], validMiddle, validForward])
+  lengths = valid.sum(axis=1)
+  pointTime = times[valid]
+
+  # windows grow with the number of steps to the closer trigger of the pair
+  owner = np.repeat(np.arange(n), lengths)
+  pairSteps = np.round(np.abs(t1 - t2) / deltas)[owner]
+  closer = np.where(np.abs(pointTime - t1[owner]) > np.abs(pointTime - t2[owner]), t2[owner], t1[owner])
+  timeSteps = np.round(np.abs(pointTime - closer) / deltas[owner])
+  pointWindow = timeWindow * np.sqrt((2 * timeSteps**2) / pairSteps**2 + 1)
+
+  return lengths, pointTime, pointWindow
+
+
+def batchTemplates(stacked, offsets, pairI, pairJ, pairSegment, sequence, maxSeq, minDeltas, timeWindow, maxLength=None):
+  '''
+  Generates the templates of all pairs of a batch, in the flat array layout
+  of pairTemplates with an additional 'segment' entry per template.
+
+  Params:     stacked:         stacked trigger arrays
+              offsets:         segment offsets from stackSegments
+              pairI, pairJ:    stacked trigger numbers of each pair
+              pairSegment:     segment of each pair
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+              minDeltas:       minimum sequence unit of each segment
+              timeWindow:      allowed time uncertainty
+
+  Optional:   maxLength:       maximum number of time locations outside the
+                               trigger pair, no limit by default
+
+  Returns:    templates:       dictionary of template and time location arrays
+  '''
+
+  times = stacked['baryTime']
+  terms = np.array(sequence(1, maxSeq), dtype=float)
+  table = np.array(subsequenceTable(sequence, maxSeq), dtype=float)
+
+  # time range of each segment, as in likelihood
+  minTimes = np.array([times[a:b].min() for a, b in zip(offsets[:-1], offsets[1:])])
+  maxTimes = np.array([times[a:b].max() + 1 for a, b in zip(offsets[:-1], offsets[1:])])
+
+  # admissible subsequences of every pair, in the order of timeLocations
+  step = times[pairJ] - times[pairI]
+  deltas = step[:, None] / table[:, 2]
+  admissible = deltas > minDeltas[pairSegment][:, None]
+  comboPair, comboEntry = np.nonzero(admissible)
+  comboDelta = deltas[comboPair, comboEntry]
+
+  # rows are padded to the longest row of their chunk, so chunks group
+  # combinations of similar estimated length
+  t1, t2 = times[pairI[comboPair]], times[pairJ[comboPair]]
+  comboMin, comboMax = minTimes[pairSegment[comboPair]], maxTimes[pairSegment[comboPair]]
+  estimates = (np.ceil((t1 - comboMin) / (comboDelta * terms.min())) +
+               np.ceil((comboMax - t2) / (comboDelta * terms.min())) + len(terms) + 1)
+
+  lengths = np.zeros(len(comboPair), dtype=int)
+  pointTime, pointWindow, pointCombo = [np.zeros(0)], [np.zeros(0)], [np.zeros(0, dtype=int)]
+  for c in latticeChunks(estimates):
+    e = comboEntry[c]
+    chunk = latticeTemplates(t1[c], t2[c], comboDelta[c], table[e, 0].astype(int), table[e, 1].astype(int),
+                             comboMin[c], comboMax[c], terms, timeWindow, maxLength=maxLength)
+    lengths[c] = chunk[0]
+    pointTime.append(chunk[1])
+    pointWindow.append(chunk[2])
+    pointCombo.append(np.repeat(c, chunk[0]))
+
+  # back to combination order; the stable sort keeps each combination's
+  # locations chronological
+  order = np.argsort(np.concatenate(pointCombo), kind='stable')
+  pointTime = np.concatenate(pointTime)[order]
+  pointWindow = np.concatenate(pointWindow)[order]
+
+  # combinations without time locations produce no template
+  templatePair = comboPair[lengths > 0]
+  lengths = lengths[lengths > 0]
+  midLat, midLong = angularMidpoints(stacked['lat0'][pairI], stacked['long0'][pairI],
+                                     stacked['lat0'][pairJ], stacked['long0'][pairJ])
+
+  return {'i': pairI[templatePair], 'j': pairJ[templatePair], 'segment': pairSegment[templatePair],
+          'midLat': midLat[templatePair], 'midLong': midLong[templatePair],
+          'length': lengths,
+          'pointTime': pointTime,
+          'pointWindow': pointWindow,
+          'pointTemplate': np.repeat(np.arange(len(lengths)), lengths)}
+
+
+def scoreBatch(templates, stacked, offsets, distanceWindow, timeWindow, totalTimes):
+  '''
+  Scores all templates of a batch at once, as scoreTemplates does for each
+  segment.
+
+  Returns:  scores:       log likelihood of each template
+            candidates:   number of signal candidates of each template
+  '''
+
+  owner = templates['pointTemplate']
+  pointSegment = templates['segment'][owner]
+  nTemplates = len(templates['length'])
+
+  # closest trigger of each location within its own segment
+  nearest = np.zeros(len(owner), dtype=int)
+  pointStarts = np.searchsorted(pointSegment, np.arange(len(offsets)))
+  for s, (a, b) in enumerate(zip(pointStarts[:-1], pointStarts[1:])):
+    if b > a:
+      nearest[a:b] = offsets[s] + nearestTriggers(stacked['baryTime'][offsets[s]:offsets[s+1]], templates['pointTime'][a:b])
+
+  # sky check and Gaussian statistic as in pointStatistics
+  distances = greatCircleDistances(stacked['lat0'][nearest], stacked['long0'][nearest],
+                                   templates['midLat'][owner], templates['midLong'][owner])
+  gaussianStatistic = stats.norm.logpdf(stacked['baryTime'][nearest], loc=templates['pointTime'],
+                                        scale=templates['pointWindow'])
+  logTotalTimes = np.array([math.log(T) for T in totalTimes])[pointSegment]
+  candidate = (distances <= distanceWindow) & (gaussianStatistic > - logTotalTimes)
+  contributions = np.where(candidate, gaussianStatistic + logTotalTimes, 0.0)
+
+  hitSums = np.bincount(owner, weights=contributions, minlength=nTemplates)
+  candidates = np.bincount(owner, weights=candidate, minlength=nTemplates).astype(int)
+
+  # background term and combination statistic of each segment
+  numbers = np.diff(offsets)
+  start = np.array([startLogLikelihood(N, T, timeWindow) for N, T in zip(numbers, totalTimes)])
+  logCombination = np.zeros(nTemplates)
+  for N in np.unique(numbers):
+    inSegment = numbers[templates['segment']] == N
+    logCombination[inSegment] = logCombinations(templates['length'][inSegment], int(N))
+
+  return start[templates['segment']] + hitSums - logCombination, candidates
+
+
+def likelihoodBatch(segments, distanceWindow, timeWindow, sequence, maxSeq, minDelta=None, maxTemplateLength=None, prepared=False, verbose=False):
+  '''
+  Searches many small segments together. Results are those of likelihood on
+  each segment.
+
+  Params:     segments:        list of dataframes
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   minDelta:        minimum sequence unit, one 250th of each
+                               segment's duration by default
+              maxTemplateLength:  maximum number of time locations outside
+                               each trigger pair, no limit by default
+              prepared:        boolean, True if segments have already been
+                               passed through prepareSegment, False by default
+              verbose:         boolean, prints batch sizes, False by default
+
+  Returns:    results:         list of (logLikelihoodValues, maxLogLikelihood)
+                               per segment, as returned by likelihood
+  '''
+
+  if len(segments) == 0:
+    return []
+
+  dfs = segments if prepared == True else prepareBatch(segments, verbose=verbose)
+  stacked, offsets = stackSegments([segmentArrays(df) for df in dfs])
+
+  # time range and minimum sequence unit of each segment
+  times = stacked['baryTime']
+  totalTimes = np.array([times[a:b].max() + 1 - times[a:b].min() for a, b in zip(offsets[:-1], offsets[1:])])
+  minDeltas = totalTimes / 250 if minDelta is None else np.full(len(dfs), float(minDelta))
+  minSeparations = minDeltas * min(entry[2] for entry in subsequenceTable(sequence, maxSeq))
+
+  pairI, pairJ, pairSegment = batchPairs(stacked, offsets, distanceWindow, minSeparations)
+  templates = batchTemplates(stacked, offsets, pairI, pairJ, pairSegment, sequence, maxSeq, minDeltas, timeWindow,
+                             maxLength=maxTemplateLength)
+  scores, candidates = scoreBatch(templates, stacked, offsets, distanceWindow, timeWindow, totalTimes)
+
+  if verbose == True:
+    print('Segments:', len(dfs), 'pairs:', len(pairI), 'templates:', len(scores))
+
+  # split results by segment, numbering triggers within each segment
+  results = []
+  bounds = np.searchsorted(templates['segment'], np.arange(len(dfs) + 1))
+  for s, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+
+    # make sure to add failsafe in case list is completely empty
+    if a == b:
+      results.append((np.zeros(6), 0))
+      continue
+
+    segmentTemplates = {'i': templates['i'][a:b] - offsets[s], 'j': templates['j'][a:b] - offsets[s],
+                        'length': templates['length'][a:b]}
+    results.append((resultRows(segmentTemplates, scores[a:b], candidates[a:b]), scores[a:b].max()))
+
+  return results
+
+
+def runBatched(segments, distanceWindow, timeWindow, sequence, maxSeq, batchSize=64, prepared=False, **kwargs):
+  '''
+  Searches an iterable of segments in batches of batchSize.
+
+  Params:     segments:        list of data segments, or iterable of (segment
+                               number, dataframe)
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   batchSize:       number of segments searched together
+              prepared:        boolean, True if segments have already been
+                               passed through prepareSegment, False by default
+              kwargs:          further arguments of likelihoodBatch
+
+  Returns:    generator of (segment number, L, maxL) in the order of segments
+  '''
+
+  numbers, batch = [], []
+  for k, segment in numberedSegments(segments):
+    numbers.append(k)
+    batch.append(segment)
+
+    if len(batch) == batchSize:
+      for number, result in zip(numbers, likelihoodBatch(batch, distanceWindow, timeWindow, sequence, maxSeq,
+                                                         prepared=prepared, **kwargs)):
+        yield (number,) + result
+      numbers, batch = [], []
+
+  for number, result in zip(numbers, likelihoodBatch(batch, distanceWindow, timeWindow, sequence, maxSeq,
+                                                     prepared=prepared, **kwargs)):
+    yield (number,) + result
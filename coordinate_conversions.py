@@ -30,6 +30,90 @@ def greatCircleDistance(trigger1, trigger2, verbose=False):
   return greatCircleDist
 
 
+def pairwiseDistances(dataframe, rows=None):
+  '''
+  Calculate the Great Circle distances between the sky locations of many
+  triggers at once.
+
+  Params:     dataframe:   triggers with 'lat0' and 'long0' columns
+
+  Optional:   rows:        positions of triggers to find distances from, all
+                           triggers by default
+
+  Returns:    distances:   array of Great Circle distances in degrees, one row
+                           per requested trigger and one column per trigger
+  '''
+
+  # haversine distances take latitude and longitude in radians
+  coords = np.radians(dataframe[['lat0', 'long0']].to_numpy(dtype=float))
+  if rows is None:
+    rows = slice(None)
+
+  return np.degrees(haversine_distances(coords[rows], coords))
+
+
+def greatCircleDistances(lat1, long1, lat2, long2):
+  '''
+  Calculate Great Circle distances elementwise between arrays of sky
+  locations, using the same haversine formula as greatCircleDistance.
+
+  Params:   lat1, long1:   latitudes and longitudes of first locations, degrees
+            lat2, long2:   latitudes and longitudes of second locations, degrees
+
+  Returns:  distances:     array of Great Circle distances in degrees
+  '''
+
+  lat1, long1, lat2, long2 = np.radians(lat1), np.radians(long1), np.radians(lat2), np.radians(long2)
+
+  sinLat = np.sin(0.5 * (lat1 - lat2))
+  sinLong = np.sin(0.5 * (long1 - long2))
+  haversine = 2 * np.arcsin(np.sqrt(sinLat * sinLat + np.cos(lat1) * np.cos(lat2) * sinLong * sinLong))
+
+  return np.degrees(haversine)
+
+
+def angularMidpoints(lat1, long1, lat2, long2):
+  '''
+  Calculate midpoints along the Great Circle arcs between arrays of sky
+  locations, as angularMidpoint does for a single pair.
+
+  Params:   lat1, long1:   latitudes and longitudes of first locations, degrees
+            lat2, long2:   latitudes and longitudes of second locations, degrees
+
+  Returns:  latmid:        latitudes of midpoints in degrees
+            lonmid:        longitudes of midpoints in degrees
+  '''
+
+  lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(long1), np.radians(lat2), np.radians(long2)
+
+  # find midpoint in cartesian coordinates
+  xmid = (np.cos(lat1) * np.cos(lon1) + np.cos(lat2) * np.cos(lon2)) / 2
+  ymid = (np.cos(lat1) * np.sin(lon1) + np.cos(lat2) * np.sin(lon2)) / 2
+  zmid = (np.sin(lat1) + np.sin(lat2)) / 2
+
+  # retransform into latitude and longitude
+  lon = np.arctan2(ymid, xmid)
+  lat = np.arctan2(zmid, np.sqrt(xmid**2 + ymid**2))
+
+  return np.degrees(lat), np.degrees(lon)
+
+
+def skyCoordinates(dataframe):
+  '''
+  Calculates and stores longitude and latitude of each trigger by converting
+  phi to longitude and theta to latitude.
+
+  Params:   dataframe:   data containing 'phi0' and 'theta0' columns
+  Returns:  df:          updated dataframe containing 'long0' and 'lat0'
+  '''
+
+  df = dataframe
+  df['long0'] = np.where(df['phi0'] > 180, df['phi0'] - 360, df['phi0'])
+  df['lat0'] = 90 - df['theta0']
+
+  return df
+
+
 def angularMidpoint(trigger1, trigger2):
   '''
   Calculate the midpoint along the Great Circle distance between two sky
@@ -0,0 +1,270 @@
+import time
+import numpy as np
+
+# local imports
+from coordinate_conversions import pairwiseDistances, skyCoordinates
+from time_functions import subsequenceTable, firstPartners
+
+# default cost coefficients, measured for the reference likelihood on short
+# segments; calibrateCost rescales them for a given machine
+COST = {'secondsPerPairCheck': 2e-4,    # sky check of every trigger pair
+        'secondsPerPair': 5e-4,         # midpoint and templates of a passing pair
+        'secondsPerTemplate': 2e-4,     # combinatorics and bookkeeping
+        'secondsPerPoint': 9e-4,        # nearest trigger lookup of one location
+        'secondsPerPointTrigger': 2e-9, # part of the lookup growing with triggers
+        'bytesPerTemplate': 400,        # stored row of log likelihood values
+        'bytesPerPoint': 48}            # time location and window of one pair
+
+# number of triggers whose pair distances are computed at a time
+CHUNK = 2000
+
+
+def costPrepass(dataframe, distanceWindow, sequence, maxSeq):
+  '''
+  Quick pass over a segment collecting everything the cost of a search
+  depends on: the trigger pairs passing the sky check and the sums of all
+  subsequences joining a pair. Barycentre times are used if present,
+  otherwise Earth arrival times, as the difference does not matter for
+  counting.
+
+  Params:   dataframe:       background or foreground data as pandas dataframe
+            distanceWindow:  allowed distance uncertainty window
+            sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+            maxSeq:          max number of steps before sequence restarts
+
+  Returns:  prepass:         dictionary of pair times, subsequence sums and
+                             segment properties used by predictCost
+  '''
+
+  timeColumn = 'baryTime' if 'baryTime' in dataframe else 'time0'
+  df = skyCoordinates(dataframe.copy()).sort_values(by=timeColumn, ignore_index=True)
+  times = df[timeColumn].to_numpy(dtype=float)
+  n = len(times)
+
+  # find pairs passing the sky check, a block of rows at a time
+  pairI, pairJ = [], []
+  for start in range(0, n, CHUNK):
+    distances = pairwiseDistances(df, rows=slice(start, start + CHUNK))
+    rows, cols = np.nonzero(distances <= distanceWindow)
+    later = cols > rows + start
+    pairI.append(rows[later] + start)
+    pairJ.append(cols[later])
+  pairI = np.concatenate(pairI) if pairI else np.zeros(0, dtype=int)
+  pairJ = np.concatenate(pairJ) if pairJ else np.zeros(0, dtype=int)
+
+  # subsequences joining the two triggers of a pair, as in timeLocations
+  subsequences = subsequenceTable(sequence, maxSeq)
+
+  return {'i': pairI, 'j': pairJ,
+          't1': times[pairI],
+          't2': times[pairJ],
+          'times': times,
+          'numberOfTriggers': n,
+          'minTime': times.min(),
+          'maxTime': times.max() + 1,
+          'midPoints': np.array([j - i for i, j, _ in subsequences]),
+          'sums': np.array([s for _, _, s in subsequences], dtype=float),
+          'cycle': float(sum(sequence(1, maxSeq))),
+          'maxSeq': maxSeq}
+
+
+def predictCost(prepass, minDelta=None, maxTemplateLength=None, coefficients=None):
+  '''
+  Predicts the work a search generates from a prepass. Numbers of time
+  locations outside the trigger pair are estimated from the mean step of one
+  sequence cycle, so they are exact up to one location per side.
+
+  Params:     prepass:            result of costPrepass
+
+  Optional:   minDelta:           minimum sequence unit, one 250th of the
+                                  segment duration by default
+              maxTemplateLength:  maximum number of time locations outside the
+                                  trigger pair, no limit by default
+              coefficients:       dictionary of cost coefficients, COST by
+                                  default
+
+  Returns:    cost:               dictionary of predicted pairs, templates,
+                                  time locations, seconds and bytes
+  '''
+
+  c = dict(COST, **(coefficients or {}))
+  n = prepass['numberOfTriggers']
+  totalTime = prepass['maxTime'] - prepass['minTime']
+  if minDelta is None:
+    minDelta = totalTime / 250
+
+  # likelihood only visits pairs further apart than minDelta times the
+  # shortest subsequence
+  times = prepass['times']
+  minSeparation = minDelta * prepass['sums'].min()
+  partners = firstPartners(times, minSeparation)
+  step = prepass['t2'] - prepass['t1']
+  visited = prepass['j'] >= partners[prepass['i']]
+
+  # sequence unit of every visited pair and subsequence
+  step = step[visited]
+  delta = step[:, None] / prepass['sums'][None, :]
+  valid = delta > minDelta
+
+  # locations per template before, between and after the pair
+  with np.errstate(divide='ignore', invalid='ignore'):
+    perUnit = prepass['maxSeq'] / (delta * prepass['cycle'])
+    backward = np.floor((prepass['t1'][visited] - prepass['minTime'])[:, None] * perUnit)
+    forward = np.floor((prepass['maxTime'] - prepass['t2'][visited])[:, None] * perUnit)
+  outside = backward + forward
+  if maxTemplateLength is not None:
+    outside = np.minimum(outside, maxTemplateLength)
+  points = np.where(valid, outside + prepass['midPoints'][None, :], 0)
+
+  # templates are only kept if they contain any location
+  isTemplate = points > 0
+  pairPoints = points.sum(axis=1)
+
+  cost = {'pairsChecked': int((n - partners).sum()),
+          'pairsPassing': len(step),
+          'pairsWithTemplates': int(np.count_nonzero(isTemplate.any(axis=1))),
+          'templates': int(np.count_nonzero(isTemplate)),
+          'points': int(points.sum()),
+          'minPeriod': float(delta[isTemplate].min()) if isTemplate.any() else None,
+          'minDelta': float(minDelta),
+          'maxTemplateLength': maxTemplateLength}
+
+  cost['seconds'] = (cost['pairsChecked'] * c['secondsPerPairCheck']
+                     + cost['pairsPassing'] * c['secondsPerPair']
+                     + cost['templates'] * c['secondsPerTemplate']
+                     + cost['points'] * (c['secondsPerPoint'] + n * c['secondsPerPointTrigger']))
+  cost['bytes'] = int(cost['templates'] * c['bytesPerTemplate']
+                       + (pairPoints.max() if len(step) else 0) * c['bytesPerPoint'])
+
+  return cost
+
+
+def estimateCost(dataframe, distanceWindow, sequence, maxSeq, minDelta=None, maxTemplateLength=None, coefficients=None):
+  '''
+  Predicts the number of pairs, templates and time locations a segment will
+  generate, together with its run time and memory.
+
+  Params:     dataframe:          background or foreground data
+              distanceWindow:     allowed distance uncertainty window
+              sequence:           sequence function
+              maxSeq:             max number of steps before sequence restarts
+
+  Optional:   minDelta, maxTemplateLength, coefficients:  see predictCost
+
+  Returns:    cost:               dictionary of predicted work, see predictCost
+  '''
+
+  prepass = costPrepass(dataframe, distanceWindow, sequence, maxSeq)
+  return predictCost(prepass, minDelta=minDelta, maxTemplateLength=maxTemplateLength, coefficients=coefficients)
+
+
+def fitsBudget(cost, timeBudget, memoryBudget):
+  return ((timeBudget is None or cost['seconds'] <= timeBudget) and
+          (memoryBudget is None or cost['bytes'] <= memoryBudget))
+
+
+def budgetedParameters(dataframe, distanceWindow, sequence, maxSeq, timeBudget=None, memoryBudget=None, capTemplates=False, minTemplateLength=10, coefficients=None, iterations=40):
+  '''
+  Chooses minDelta, and optionally a template length cap, such that the
+  predicted cost of a segment fits a time and memory budget. Templates are
+  shortened first, if allowed, so that fast sequences are not given up while
+  cutting the furthest time locations suffices; otherwise minDelta is raised
+  as little as possible.
+
+  Params:     dataframe:          background or foreground data
+              distanceWindow:     allowed distance uncertainty window
+              sequence:           sequence function
+              maxSeq:             max number of steps before sequence restarts
+
+  Optional:   timeBudget:         maximum predicted run time in seconds
+              memoryBudget:       maximum predicted memory in bytes
+              capTemplates:       boolean, allows capping template lengths,
+                                  False by default
+              minTemplateLength:  shortest cap that may be chosen
+              coefficients:       dictionary of cost coefficients
+              iterations:         number of bisection steps
+
+  Returns:    minDelta:           minimum sequence unit to pass to likelihood
+              maxTemplateLength:  template length cap to pass to likelihood,
+                                  None if templates are not capped
+              report:             dictionary of default and chosen cost and of
+                                  what was given up
+  '''
+
+  prepass = costPrepass(dataframe, distanceWindow, sequence, maxSeq)
+  predict = lambda d, l: predictCost(prepass, minDelta=d, maxTemplateLength=l, coefficients=coefficients)
+
+  totalTime = prepass['maxTime'] - prepass['minTime']
+  minDelta = totalTime / 250
+  maxTemplateLength = None
+  default = predict(minDelta, None)
+  chosen = default
+
+  if not fitsBudget(chosen, timeBudget, memoryBudget) and capTemplates == True:
+
+    # bisect on the largest cap that fits, as cost grows with the cap
+    longest = int(np.ceil(2 * totalTime / minDelta))
+    if fitsBudget(predict(minDelta, minTemplateLength), timeBudget, memoryBudget):
+      low, high = minTemplateLength, longest
+      while high - low > 1:
+        middle = (low + high) // 2
+        if fitsBudget(predict(minDelta, middle), timeBudget, memoryBudget):
+          low = middle
+        else:
+          high = middle
+      maxTemplateLength = low
+    else:
+      maxTemplateLength = minTemplateLength
+    chosen = predict(minDelta, maxTemplateLength)
+
+  if not fitsBudget(chosen, timeBudget, memoryBudget):
+
+    # bisect in log space on the smallest minDelta that fits, as cost falls
+    # with minDelta and no template is left once it reaches the total time
+    low, high = np.log(minDelta), np.log(totalTime)
+    for _ in range(iterations):
+      middle = (low + high) / 2
+      if fitsBudget(predict(np.exp(middle), maxTemplateLength), timeBudget, memoryBudget):
+        high = middle
+      else:
+        low = middle
+    minDelta = float(np.exp(high))
+    chosen = predict(minDelta, maxTemplateLength)
+
+  report = {'default': default, 'chosen': chosen,
+            'fits': fitsBudget(chosen, timeBudget, memoryBudget),
+            'pairsDropped': default['pairsWithTemplates'] - chosen['pairsWithTemplates'],
+            'templatesDropped': default['templates'] - chosen['templates'],
+            'pointsDropped': default['points'] - chosen['points']}
+
+  return minDelta, maxTemplateLength, report
+
+
+def calibrateCost(dataframe, distanceWindow, timeWindow, sequence, maxSeq, coefficients=None):
+  '''
+  Rescales the time coefficients so that the predicted run time of a segment
+  matches a measured run of the reference likelihood on this machine.
+
+  Params:     dataframe:       data segment to time, should be short
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   coefficients:    dictionary of cost coefficients to rescale
+
+  Returns:    coefficients:    dictionary of rescaled cost coefficients
+  '''
+
+  # imported here as likelihood pulls in plotting
+  from likelihood_calculations import likelihood
+
+  c = dict(COST, **(coefficients or {}))
+  predicted = estimateCost(dataframe, distanceWindow, sequence, maxSeq, coefficients=c)['seconds']
+
+  start = time.perf_counter()
+  likelihood(dataframe.copy(), distanceWindow, timeWindow, sequence, maxSeq)
+  measured = time.perf_counter() - start
+
+  scale = measured / predicted if predicted > 0 else 1
+  return {k: v * scale if k.startswith('seconds') else v for k, v in c.items()}
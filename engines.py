@@ -0,0 +1,145 @@
+import time
+import functools
+import numpy as np
+
+# local imports
+from likelihood_calculations import likelihood, prepareSegment
+from fast_search import likelihoodFast
+from result_store import templateRows
+
+# search engines with the arguments and results of likelihood; 'reference' is
+# the original loop over pairs and time locations and defines correct results,
+# and 'reference-prefilter' skips its time locations in empty time and is exact
+ENGINES = {'reference': likelihood,
+           'reference-prefilter': functools.partial(likelihood, prefilter=True),
+           'fast': likelihoodFast}
+
+
+def getEngine(engine):
+  '''
+  Returns the likelihood function of a search engine.
+
+  Params:   engine:   name of engine in ENGINES, or a likelihood function
+  Returns:  function with the arguments and results of likelihood
+  '''
+
+  if callable(engine):
+    return engine
+
+  if engine not in ENGINES:
+    raise ValueError('Unknown engine {0}, choose from {1}'.format(engine, list(ENGINES)))
+
+  return ENGINES[engine]
+
+
+def rowKeys(L):
+  '''
+  Identifies each template result by its pair, length and position among the
+  templates of its pair, so that results of two engines can be matched.
+  '''
+
+  keys = []
+  seen = {}
+  for row in L:
+    pair = (int(row[1]), int(row[2]), int(row[3]))
+    seen[pair] = seen.get(pair, -1) + 1
+    keys.append(pair + (seen[pair],))
+
+  return keys
+
+
+def compareResults(L1, maxL1, L2, maxL2, rtol, atol):
+  '''
+  Compares the results of two engines on the same segment.
+
+  Returns:  comparison:   dictionary of maximum difference, number of
+                          templates only found by one engine, and numbers of
+                          templates with different scores or candidates
+  '''
+
+  L1, L2 = templateRows(L1), templateRows(L2)
+
+  rows1 = dict(zip(rowKeys(L1), L1))
+  rows2 = dict(zip(rowKeys(L2), L2))
+  common = [key for key in rows1 if key in rows2]
+
+  scores1 = np.array([rows1[key][0] for key in common])
+  scores2 = np.array([rows2[key][0] for key in common])
+  candidates1 = np.array([rows1[key][4:6] for key in common]).reshape(-1, 2)
+  candidates2 = np.array([rows2[key][4:6] for key in common]).reshape(-1, 2)
+
+  return {'maxDifference': float(abs(maxL1 - maxL2)),
+          'maxMatches': bool(np.isclose(maxL1, maxL2, rtol=rtol, atol=atol)),
+          'missingTemplates': len(rows1) - len(common),
+          'extraTemplates': len(rows2) - len(common),
+          'scoreMismatches': int(np.count_nonzero(~np.isclose(scores1, scores2, rtol=rtol, atol=atol))),
+          'maxScoreDifference': float(np.abs(scores1 - scores2).max()) if len(common) else 0.0,
+          'candidateMismatches': int(np.count_nonzero((candidates1 != candidates2).any(axis=1)))}
+
+
+def validateEngines(segments, distanceWindow, timeWindow, sequence, maxSeq, engine='fast', reference='reference', sampleSize=None, seed=0, rtol=1e-9, atol=1e-9, engineKwargs=None, referenceKwargs=None, **kwargs):
+  '''
+  Runs an engine and the reference engine on the same segments and reports
+  differences in maximum log likelihoods and template results, together with
+  the speedup. Segments are prepared once, so timings compare the searches
+  only.
+
+  Params:     segments:        list of data segments
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   engine:          engine to validate, 'fast' by default
+              reference:       engine to compare against, 'reference' by default
+              sampleSize:      number of randomly chosen segments to compare,
+                               all segments by default
+              seed:            seed for choosing segments
+              rtol, atol:      tolerances on log likelihood differences
+              engineKwargs:    dictionary of arguments passed to the engine
+                               only, e.g. options only it accepts
+              referenceKwargs: dictionary of arguments passed to the reference
+                               engine only
+              kwargs:          further search arguments passed to both
+                               engines, e.g. minDelta or maxTemplateLength
+
+  Returns:    report:          dictionary with 'passed', overall 'speedup' and
+                               a list of per-segment comparisons
+  '''
+
+  engineFunction, referenceFunction = getEngine(engine), getEngine(reference)
+  engineKwargs = dict(kwargs, **(engineKwargs or {}))
+  referenceKwargs = dict(kwargs, **(referenceKwargs or {}))
+
+  # sub-sample segments, if prompted
+  chosen = np.arange(len(segments))
+  if sampleSize is not None and sampleSize < len(segments):
+    chosen = np.sort(np.random.default_rng(seed).choice(len(segments), sampleSize, replace=False))
+
+  comparisons = []
+  for k in chosen:
+    df = prepareSegment(segments[k].copy())
+
+    start = time.perf_counter()
+    L1, maxL1 = referenceFunction(df.copy(), distanceWindow, timeWindow, sequence, maxSeq, prepared=True, **referenceKwargs)
+    referenceTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    L2, maxL2 = engineFunction(df.copy(), distanceWindow, timeWindow, sequence, maxSeq, prepared=True, **engineKwargs)
+    engineTime = time.perf_counter() - start
+
+    comparison = compareResults(L1, maxL1, L2, maxL2, rtol, atol)
+    comparison.update({'segment': int(k), 'referenceMaxL': maxL1, 'engineMaxL': maxL2,
+                       'referenceTime': referenceTime, 'engineTime': engineTime,
+                       'speedup': referenceTime / engineTime if engineTime > 0 else float('inf')})
+    comparison['passed'] = (comparison['maxMatches'] and comparison['missingTemplates'] == 0 and
+                            comparison['extraTemplates'] == 0 and comparison['scoreMismatches'] == 0 and
+                            comparison['candidateMismatches'] == 0)
+    comparisons.append(comparison)
+
+  totalReference = sum(c['referenceTime'] for c in comparisons)
+  totalEngine = sum(c['engineTime'] for c in comparisons)
+
+  return {'passed': all(c['passed'] for c in comparisons),
+          'speedup': totalReference / totalEngine if totalEngine > 0 else float('inf'),
+          'segments': comparisons}
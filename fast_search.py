@@ -0,0 +1,300 @@
+import math
+import numpy as np
+from scipy import stats
+
+# local imports
+from coordinate_conversions import greatCircleDistances, angularMidpoints
+from likelihood_calculations import likelihood, prepareSegment
+from time_functions import timeLocations, subsequenceTable, admissibleSubsequences, firstPartners
+from trigger_search import pointStatistics
+from statistics import combinations
+
+# Array versions of the steps of likelihood. A prepared segment is handled as
+# a dictionary of 'baryTime', 'lat0' and 'long0' arrays sorted by time, and
+# all templates of a segment are kept in flat arrays: one entry per template
+# ('i', 'j', 'midLat', 'midLong', 'length') and one entry per time location
+# ('pointTime', 'pointWindow', 'pointTemplate').
+
+
+def segmentArrays(df):
+  '''
+  Extracts the columns used by the search from a prepared segment.
+
+  Params:   df:        dataframe passed through prepareSegment
+  Returns:  triggers:  dictionary of time and sky coordinate arrays
+  '''
+
+  return {key: df[key].to_numpy(dtype=float) for key in ['baryTime', 'lat0', 'long0']}
+
+
+def segmentTimes(triggers):
+  '''
+  Returns minimum time, maximum time and total time of a segment as defined
+  in likelihood.
+  '''
+
+  minTime = triggers['baryTime'].min()
+  maxTime = triggers['baryTime'].max() + 1
+
+  return minTime, maxTime, maxTime - minTime
+
+
+def candidatePairs(triggers, distanceWindow, minSeparation, involving=None, firstTriggers=None, maxSeparation=None):
+  '''
+  Lists trigger pairs that are far enough apart in time to produce templates
+  and pass the sky check, in the order likelihood visits them.
+
+  Params:     triggers:        dictionary of trigger arrays
+              distanceWindow:  allowed distance uncertainty window
+              minSeparation:   minDelta times the shortest subsequence sum
+
+  Optional:   involving:       boolean array, only pairs with at least one
+                               trigger marked True are listed
+              firstTriggers:   range of first triggers of the pairs to list,
+                               all triggers by default
+              maxSeparation:   largest time separation of a pair, no limit
+                               by default
+
+  Returns:    pairI, pairJ:    arrays of first and second trigger of each pair
+  '''
+
+  times, lat, long = triggers['baryTime'], triggers['lat0'], triggers['long0']
+  partners = firstPartners(times, minSeparation)
+  n = len(times)
+  lastPartners = np.full(n, n) if maxSeparation is None else np.searchsorted(times, times + maxSeparation, side='right')
+
+  pairI, pairJ = [], []
+  for i in (range(n - 1) if firstTriggers is None else firstTriggers):
+    j = np.arange(partners[i], lastPartners[i])
+
+    # only pairs with a marked trigger, if prompted
+    if involving is not None and not involving[i]:
+      j = j[involving[j]]
+
+    # vectorised version of the initial similarity check
+    j = j[greatCircleDistances(lat[i], long[i], lat[j], long[j]) <= distanceWindow]
+
+    pairI.append(np.full(len(j), i))
+    pairJ.append(j)
+
+  if not pairI:
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+  return np.concatenate(pairI).astype(int), np.concatenate(pairJ).astype(int)
+
+
+def pairTemplates(triggers, pairI, pairJ, sequence, maxSeq, minDelta, timeWindow, subsequences, maxLength=None):
+  '''
+  Generates the templates of every trigger pair with timeLocations and
+  collects them in flat arrays.
+
+  Params:     triggers:        dictionary of trigger arrays
+              pairI, pairJ:    arrays of first and second trigger of each pair
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+              minDelta:        minimum sequence unit
+              timeWindow:      allowed time uncertainty
+              subsequences:    subsequence table from subsequenceTable
+
+  Optional:   maxLength:       maximum number of time locations outside the
+                               trigger pair, no limit by default
+
+  Returns:    templates:       dictionary of template and time location arrays
+  '''
+
+  times = triggers['baryTime']
+  minTime, maxTime, _ = segmentTimes(triggers)
+  midLat, midLong = angularMidpoints(triggers['lat0'][pairI], triggers['long0'][pairI],
+                                     triggers['lat0'][pairJ], triggers['long0'][pairJ])
+
+  templatePair, lengths, pointTime, pointWindow = [], [], [], []
+  for k, (i, j) in enumerate(zip(pairI, pairJ)):
+    timeLocs, timeWindows, _ = timeLocations(times[i], times[j], minTime, maxTime, sequence, maxSeq,
+                                             minDelta, timeWindow, maxLength=maxLength,
+                                             subsequences=admissibleSubsequences(subsequences, times[j] - times[i], minDelta))
+    for seqList, seqWindows in zip(timeLocs, timeWindows):
+      templatePair.append(k)
+      lengths.append(len(seqList))
+      pointTime.extend(seqList)
+      pointWindow.extend(seqWindows)
+
+  templatePair = np.array(templatePair, dtype=int)
+  lengths = np.array(lengths, dtype=int)
+
+  return {'i': pairI[templatePair], 'j': pairJ[templatePair],
+          'midLat': midLat[templatePair], 'midLong': midLong[templatePair],
+          'length': lengths,
+          'pointTime': np.array(pointTime, dtype=float),
+          'pointWindow': np.array(pointWindow, dtype=float),
+          'pointTemplate': np.repeat(np.arange(len(lengths)), lengths)}
+
+
+def concatenateTemplates(*templateSets):
+  '''
+  Joins several sets of templates into one.
+  '''
+
+  joined = {key: np.concatenate([t[key] for t in templateSets]) for key in templateSets[0]}
+
+  # template numbers of time locations continue from one set to the next
+  offsets = np.cumsum([0] + [len(t['length']) for t in templateSets[:-1]])
+  joined['pointTemplate'] = np.concatenate([t['pointTemplate'] + o for t, o in zip(templateSets, offsets)])
+
+  return joined
+
+
+def logCombinations(lengths, numberOfTriggers):
+  '''
+  Log of the combination statistic of each template, computed once for each
+  distinct template length.
+
+  Params:   lengths:           number of time locations of each template
+            numberOfTriggers:  total number of triggers searched over
+
+  Returns:  array of log combination statistics
+  '''
+
+  unique, inverse = np.unique(lengths, return_inverse=True)
+  logs = np.array([math.log(combinations(int(m) + 2, numberOfTriggers)) for m in unique])
+
+  return logs[inverse] if len(unique) else np.zeros(0)
+
+
+def startLogLikelihood(numberOfTriggers, totalTime, timeWindow):
+  '''
+  Log likelihood of a template before any time location is searched, as
+  logLikelihoodStart in likelihood.
+  '''
+
+  logLikelihoodT = stats.norm.logpdf(0, loc=0, scale=timeWindow)
+  return - numberOfTriggers * math.log(totalTime) + 2 * logLikelihoodT
+
+
+def templateScores(templates, hitSums, numberOfTriggers, totalTime, timeWindow):
+  '''
+  Log likelihood of each template from the summed contributions of its time
+  locations.
+  '''
+
+  start = startLogLikelihood(numberOfTriggers, totalTime, timeWindow)
+  return start + hitSums - logCombinations(templates['length'], numberOfTriggers)
+
+
+def scoreTemplates(templates, triggers, distanceWindow, timeWindow, totalTime=None):
+  '''
+  Scores all templates of a segment at once.
+
+  Params:     templates:        dictionary of template arrays
+              triggers:         dictionary of trigger arrays
+              distanceWindow:   allowed distance uncertainty window
+              timeWindow:       allowed time uncertainty
+
+  Optional:   totalTime:        full time range, taken from triggers by default
+
+  Returns:    scores:           log likelihood of each template
+              candidates:       number of signal candidates of each template
+              points:           dictionary of 'contribution', 'candidate' and
+                                'nearest' arrays, one entry per time location
+  '''
+
+  if totalTime is None:
+    totalTime = segmentTimes(triggers)[2]
+  nTemplates = len(templates['length'])
+  owner = templates['pointTemplate']
+
+  contributions, candidate, nearest = pointStatistics(totalTime, triggers, templates['pointTime'], templates['pointWindow'],
+                                                      templates['midLat'][owner], templates['midLong'][owner], distanceWindow)
+
+  hitSums = np.bincount(owner, weights=contributions, minlength=nTemplates)
+  candidates = np.bincount(owner, weights=candidate, minlength=nTemplates).astype(int)
+  scores = templateScores(templates, hitSums, len(triggers['baryTime']), totalTime, timeWindow)
+
+  return scores, candidates, {'contribution': contributions, 'candidate': candidate, 'nearest': nearest}
+
+
+def resultRows(templates, scores, candidates):
+  '''
+  Arranges template results in the array format returned by likelihood.
+  '''
+
+  if len(scores) == 0:
+    return np.zeros(6)
+
+  return np.column_stack([scores, templates['i'], templates['j'], templates['length'] + 2,
+                          candidates, (candidates > 0).astype(int)])
+
+
+def likelihoodFast(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=None, paramMidpoints=None, paramWindows=None, minDelta=None, maxTemplateLength=None, prepared=False, plot=False, verbose=False):
+  '''
+  Array version of likelihood with the same arguments and results. Pairs are
+  enumerated with vectorised sky checks and all time locations of a segment
+  are scored at once. Checks on further parameters and plotting are only
+  provided by likelihood, which is called instead if they are requested.
+
+  Params:     see likelihood
+
+  Returns:    logLikelihoodValues:   array of log likelihoods for each sequence
+              maxLogLikelihood:      maximum log likelihood value
+  '''
+
+  if params is not None or plot == True:
+    return likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=params,
+                      paramMidpoints=paramMidpoints, paramWindows=paramWindows, minDelta=minDelta,
+                      maxTemplateLength=maxTemplateLength, prepared=prepared, plot=plot, verbose=verbose)
+
+  # barycentre and sort data, unless this has been done beforehand
+  df = dataframe if prepared == True else prepareSegment(dataframe, verbose=verbose)
+  triggers = segmentArrays(df)
+  print('Total time:', segmentTimes(triggers)[2] / (24 * 3600), 'days')
+
+  return searchTriggers(triggers, distanceWindow, timeWindow, sequence, maxSeq, minDelta=minDelta,
+                        maxTemplateLength=maxTemplateLength, verbose=verbose)
+
+
+def searchTriggers(triggers, distanceWindow, timeWindow, sequence, maxSeq, minDelta=None, maxTemplateLength=None, firstTriggers=None, maxSeparation=None, verbose=False):
+  '''
+  Searches the trigger arrays of a prepared segment, as likelihoodFast.
+
+  Params:     triggers:              dictionary of trigger arrays
+              distanceWindow:        allowed distance uncertainty window
+              timeWindow:            allowed time uncertainty
+              sequence:              sequence function (e.g.: primes, ...)
+              maxSeq:                max number of steps before sequence restarts
+
+  Optional:   minDelta:              minimum sequence unit, one 250th of the
+                                     segment duration by default
+              maxTemplateLength:     maximum number of time locations outside
+                                     each trigger pair, no limit by default
+              firstTriggers:         range of first triggers of the pairs to
+                                     search, all pairs by default; results of
+                                     consecutive ranges join in the order of
+                                     likelihood
+              maxSeparation:         largest time separation of a pair, no
+                                     limit by default
+
+  Returns:    logLikelihoodValues:   array of log likelihoods for each sequence
+              maxLogLikelihood:      maximum log likelihood value
+  '''
+
+  minTime, maxTime, totalTime = segmentTimes(triggers)
+  if minDelta is None:
+    minDelta = totalTime / 250
+
+  subsequences = subsequenceTable(sequence, maxSeq)
+  minSeparation = minDelta * min(entry[2] for entry in subsequences)
+
+  pairI, pairJ = candidatePairs(triggers, distanceWindow, minSeparation, firstTriggers=firstTriggers,
+                                maxSeparation=maxSeparation)
+
+  templates = pairTemplates(triggers, pairI, pairJ, sequence, maxSeq, minDelta, timeWindow, subsequences,
+                            maxLength=maxTemplateLength)
+  scores, candidates, _ = scoreTemplates(templates, triggers, distanceWindow, timeWindow, totalTime)
+
+  if verbose == True:
+    print('Pairs:', len(pairI), 'templates:', len(scores))
+
+  # make sure to add failsafe in case list is completely empty
+  if len(scores) == 0:
+    return np.zeros(6), 0
+
+  return resultRows(templates, scores, candidates), scores.max()
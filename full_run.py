@@ -0,0 +1,265 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# local imports
+from likelihood_calculations import prepareSegment
+from time_functions import subsequenceTable
+from fast_search import searchTriggers
+from result_store import openColumn, templateRows
+
+# A full observing run is searched in overlapping windows instead of
+# independent segments. All triggers are first barycentred and sorted once
+# into a time index on disk, one memory mapped .npy file per column:
+#
+#   indexDir/<column>.npy      baryTime, lat0, long0, and the row of each
+#                              trigger in the catalogue
+#   indexDir/index.json        number of triggers
+#
+# A segment bounds the sequence unit of its templates by its duration, a run
+# does not, so the run is searched for units between minDelta and maxDelta.
+# A pair further apart than maxDelta times the largest subsequence sum only
+# produces templates with a larger unit, which sets span, the longest pair
+# separation that is searched. Closer pairs keep all their templates, so
+# some units above maxDelta are searched as well, as in a segment.
+#
+# Windows then step through the run by stride. Window w owns the pairs whose
+# first trigger falls into its core [start + w*stride, start + (w+1)*stride)
+# and whose second trigger follows within span, so every pair is searched
+# exactly once, including pairs across core boundaries. To score these
+# pairs the window reads the triggers of its extent, the core widened by
+# span on both sides, and its templates run over the whole extent. Only one
+# extent is held in memory at a time.
+#
+# Normalisation is local: the total time T, the number of triggers N and the
+# time range of the templates are those of the extent of the owning window,
+# which plays the part of a segment in likelihood. The extents of the first
+# and last windows of a run are cut short by its ends, so their maxima come
+# from a smaller T and N than those of interior windows and are only
+# comparable with backgrounds of extents of the same duration, which the
+# summary of each window records.
+
+# columns of the time index and the type they are stored as
+INDEX_COLUMNS = [('baryTime', np.float64), ('lat0', np.float64), ('long0', np.float64), ('row', np.int64)]
+
+# number of triggers sorted at a time when building the index
+CHUNK = 1000000
+
+# typical duration of a segment of the segment search in seconds, which sets
+# the default range of sequence units
+SEGMENT_DURATION = 25 * 24 * 3600
+
+
+def buildTimeIndex(catfile, indexDir, chunkSize=100000, verbose=False):
+  '''
+  Barycentres a whole trigger catalogue and writes its time index.
+
+  Params:     catfile:      catalogue file with the columns of the background
+                            data files
+              indexDir:     directory of time index
+
+  Optional:   chunkSize:    number of catalogue rows barycentred at a time
+              verbose:      boolean, prints progress, False by default
+
+  Returns:    n:            number of triggers in the index
+  '''
+
+  os.makedirs(indexDir, exist_ok=True)
+  rawPaths = {name: os.path.join(indexDir, name + '.raw') for name, _ in INDEX_COLUMNS}
+
+  # barycentre chunk by chunk, appending unsorted columns to raw files
+  n = 0
+  rawFiles = {name: open(path, 'wb') for name, path in rawPaths.items()}
+  try:
+    with pd.read_csv(catfile, chunksize=chunkSize) as reader:
+      for chunk in reader:
+        chunk['row'] = np.arange(n, n + len(chunk))
+        df = prepareSegment(chunk)
+        for name, dtype in INDEX_COLUMNS:
+          rawFiles[name].write(df[name].to_numpy(dtype=dtype).tobytes())
+        n += len(chunk)
+        if verbose == True:
+          print('Barycentred triggers:', n)
+  finally:
+    for f in rawFiles.values():
+      f.close()
+
+  # sort all columns by barycentre time, a block at a time
+  order = np.argsort(np.fromfile(rawPaths['baryTime'], dtype=np.float64), kind='stable')
+  for name, dtype in INDEX_COLUMNS:
+    column = openColumn(os.path.join(indexDir, name + '.npy'), dtype, n)
+    if n > 0:
+      raw = np.memmap(rawPaths[name], dtype=dtype, mode='r', shape=(n,))
+      for start in range(0, n, CHUNK):
+        column[start:start + CHUNK] = raw[order[start:start + CHUNK]]
+      column.flush()
+      del raw
+    del column
+    os.remove(rawPaths[name])
+
+  with open(os.path.join(indexDir, 'index.json'), 'w') as f:
+    json.dump({'triggers': n, 'catalogue': str(catfile)}, f)
+
+  return n
+
+
+def openTimeIndex(indexDir):
+  '''
+  Opens a time index written by buildTimeIndex.
+
+  Returns:  index:    dictionary of memory mapped columns
+  '''
+
+  with open(os.path.join(indexDir, 'index.json')) as f:
+    n = json.load(f)['triggers']
+
+  # empty files cannot be memory mapped
+  mode = 'r' if n > 0 else None
+
+  return {name: np.load(os.path.join(indexDir, name + '.npy'), mmap_mode=mode) for name, _ in INDEX_COLUMNS}
+
+
+def windowSpan(sequence, maxSeq, maxDelta):
+  '''
+  Longest time separation of a trigger pair with a template of sequence unit
+  at most maxDelta.
+
+  Params:   sequence:   sequence function (e.g.: primes, Fibonacci, ...)
+            maxSeq:     max number of steps before sequence restarts
+            maxDelta:   largest sequence unit searched
+
+  Returns:  span:       maxDelta times the largest subsequence sum
+  '''
+
+  return maxDelta * max(entry[2] for entry in subsequenceTable(sequence, maxSeq))
+
+
+def windowPlan(times, span, stride=None):
+  '''
+  Lists the windows of a run that own at least one trigger.
+
+  Params:     times:     sorted barycentre times of the time index
+              span:      longest time separation of a searched pair, and the
+                         width added to each side of a core
+
+  Optional:   stride:    width of window cores, span by default
+
+  Returns:    generator of dictionaries with the window number, the time
+              range of its core and the index ranges of its core and extent
+  '''
+
+  if stride is None:
+    stride = span
+  if len(times) == 0:
+    return
+
+  firstTime = times[0]
+  nWindows = int((times[-1] - firstTime) // stride) + 1
+
+  for w in range(nWindows):
+    start, stop = firstTime + w * stride, firstTime + (w + 1) * stride
+    core = np.searchsorted(times, [start, stop], side='left')
+    if core[0] == core[1]:
+      continue
+
+    extent = (np.searchsorted(times, start - span, side='left'), np.searchsorted(times, stop + span, side='right'))
+    yield {'window': w, 'start': start, 'stop': stop,
+           'core': (int(core[0]), int(core[1])), 'extent': (int(extent[0]), int(extent[1]))}
+
+
+def searchWindow(index, window, distanceWindow, timeWindow, sequence, maxSeq, span, minDelta, **kwargs):
+  '''
+  Searches the pairs owned by one window.
+
+  Params:     index:           time index from openTimeIndex
+              window:          window from windowPlan
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+              span:            longest time separation of a searched pair,
+                               from windowSpan
+              minDelta:        minimum sequence unit of the run
+
+  Optional:   kwargs:          further arguments of searchTriggers
+
+  Returns:    logLikelihoodValues:   array of log likelihoods for each
+                                     sequence, with trigger numbers of the
+                                     time index
+              maxLogLikelihood:      maximum log likelihood value
+  '''
+
+  first, last = window['extent']
+  coreFirst, coreLast = window['core']
+
+  # read the extent of the window into memory
+  triggers = {name: np.array(index[name][first:last]) for name in ['baryTime', 'lat0', 'long0']}
+
+  L, maxL = searchTriggers(triggers, distanceWindow, timeWindow, sequence, maxSeq, minDelta=minDelta,
+                           firstTriggers=range(coreFirst - first, coreLast - first),
+                           maxSeparation=span, **kwargs)
+
+  # number triggers as in the time index
+  if np.ndim(L) == 2:
+    L[:, 1:3] += first
+
+  return L, maxL
+
+
+def runFullSearch(indexDir, distanceWindow, timeWindow, sequence, maxSeq, minDelta=None, maxDelta=None, stride=None, writer=None, verbose=False, **kwargs):
+  '''
+  Searches a whole run in overlapping windows.
+
+  Params:     indexDir:        directory of time index from buildTimeIndex
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   minDelta:        minimum sequence unit, one 250th of
+                               SEGMENT_DURATION by default as in a segment
+              maxDelta:        largest sequence unit searched, by default the
+                               unit whose whole sequence cycle just fits into
+                               SEGMENT_DURATION; sets span with windowSpan
+              stride:          width of window cores, span by default
+              writer:          function called as writer(w, window, L, maxL)
+                               with the results of each window, e.g. to
+                               append them to a result store
+              verbose:         boolean, prints progress, False by default
+              kwargs:          further arguments of searchTriggers
+
+  Returns:    summary:         list of dictionaries with the core, number of
+                               triggers, extent duration and maximum log
+                               likelihood of each window
+  '''
+
+  index = openTimeIndex(indexDir)
+  if minDelta is None:
+    minDelta = SEGMENT_DURATION / 250
+  if maxDelta is None:
+    maxDelta = SEGMENT_DURATION / windowSpan(sequence, maxSeq, 1)
+  if maxDelta <= minDelta:
+    raise ValueError('maxDelta {0} must be larger than minDelta {1}'.format(maxDelta, minDelta))
+  span = windowSpan(sequence, maxSeq, maxDelta)
+  if verbose == True:
+    print('Sequence units from', minDelta, 'to', maxDelta, 'seconds, pairs up to', span, 'seconds apart')
+
+  summary = []
+  for window in windowPlan(index['baryTime'], span, stride=stride):
+    L, maxL = searchWindow(index, window, distanceWindow, timeWindow, sequence, maxSeq, span, minDelta, **kwargs)
+
+    if writer is not None:
+      writer(window['window'], window, L, maxL)
+
+    first, last = window['extent']
+    summary.append({'window': window['window'], 'start': float(window['start']), 'stop': float(window['stop']),
+                    'triggers': window['core'][1] - window['core'][0],
+                    'extentTriggers': last - first,
+                    'extentTime': float(index['baryTime'][last - 1] - index['baryTime'][first]),
+                    'templates': len(templateRows(L)),
+                    'maxLogLikelihood': float(maxL)})
+    if verbose == True:
+      print('Window', window['window'], 'max log likelihood:', maxL)
+
+  return summary
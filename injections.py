@@ -0,0 +1,304 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# local imports
+from time_functions import subsequenceTable
+from fast_search import (segmentArrays, segmentTimes, candidatePairs, pairTemplates, concatenateTemplates,
+                         scoreTemplates, templateScores, resultRows)
+from trigger_search import pointStatistics
+
+# Injections are scored against a background that has been searched once.
+# Adding triggers to a segment changes its results in three ways only:
+#   - all template scores shift, as the number of triggers enters the
+#     background term and the combination statistic,
+#   - time locations of background templates may find an injected trigger
+#     closer than their previous closest trigger,
+#   - pairs with an injected trigger produce new templates.
+# The first is applied to stored template sums, the second by rescoring the
+# affected time locations only, and the third by searching the new pairs.
+# Injected triggers are kept strictly inside the background time range so the
+# total time of the segment does not change.
+
+
+def prepareBackground(df, distanceWindow, timeWindow, sequence, maxSeq, minDelta=None):
+  '''
+  Searches a background segment once and keeps everything needed to score
+  injections into it.
+
+  Params:     df:              segment passed through prepareSegment
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   minDelta:        minimum sequence unit, one 250th of the segment
+                               duration by default
+
+  Returns:    background:      dictionary of trigger arrays, templates and
+                               the contribution of each time location
+  '''
+
+  triggers = segmentArrays(df)
+  minTime, maxTime, totalTime = segmentTimes(triggers)
+  if minDelta is None:
+    minDelta = totalTime / 250
+  subsequences = subsequenceTable(sequence, maxSeq)
+  minSeparation = minDelta * min(entry[2] for entry in subsequences)
+
+  # all background templates, scored once
+  pairI, pairJ = candidatePairs(triggers, distanceWindow, minSeparation)
+  templates = pairTemplates(triggers, pairI, pairJ, sequence, maxSeq, minDelta, timeWindow, subsequences)
+  scores, candidates, points = scoreTemplates(templates, triggers, distanceWindow, timeWindow, totalTime)
+
+  # distance of each time location to its closest trigger; only an injected
+  # trigger at least as close can change the location's contribution
+  points['nearestDistance'] = np.abs(triggers['baryTime'][points['nearest']] - templates['pointTime'])
+
+  nTemplates = len(scores)
+  owner = templates['pointTemplate']
+
+  return {'triggers': triggers, 'templates': templates, 'points': points,
+          'hitSums': np.bincount(owner, weights=points['contribution'], minlength=nTemplates),
+          'candidates': candidates,
+          'maxLogLikelihood': scores.max() if nTemplates else 0,
+          'minTime': minTime, 'maxTime': maxTime, 'totalTime': totalTime,
+          'minDelta': minDelta, 'minSeparation': minSeparation, 'subsequences': subsequences,
+          'distanceWindow': distanceWindow, 'timeWindow': timeWindow,
+          'sequence': sequence, 'maxSeq': maxSeq}
+
+
+def injectionTriggers(rng, background, delta, firstTime, lat, long, skySpread, timeJitter, startLoc=1, numberOfSignals=None):
+  '''
+  Generates a synthetic sequence of triggers in barycentre time.
+
+  Params:     rng:             numpy random generator
+              background:      background from prepareBackground
+              delta:           sequence unit of injected signal
+              firstTime:       time of first injected signal
+              lat, long:       sky location of the source in degrees
+              skySpread:       standard deviation of reconstructed sky
+                               positions around the source in degrees
+              timeJitter:      standard deviation of reconstructed times,
+                               e.g. timeWindow
+
+  Optional:   startLoc:        sequence location of first signal
+              numberOfSignals: maximum number of signals, all that fit into
+                               the segment by default
+
+  Returns:    injection:       dictionary of trigger arrays, sorted by time
+  '''
+
+  sequence, maxSeq = background['sequence'], background['maxSeq']
+
+  # true signal times following the sequence, restarting after maxSeq steps
+  times = []
+  time, seqLoc = firstTime, startLoc
+  while time < background['maxTime'] and (numberOfSignals is None or len(times) < numberOfSignals):
+    times.append(time)
+    time += delta * sequence(seqLoc, seqLoc)[0]
+    seqLoc = seqLoc + 1 if seqLoc < maxSeq else 1
+
+  # reconstruction errors in time and sky position
+  times = np.array(times) + rng.normal(0, timeJitter, len(times))
+  lats = np.clip(lat + rng.normal(0, skySpread, len(times)), -90, 90)
+  longs = (long + rng.normal(0, skySpread, len(times)) + 180) % 360 - 180
+
+  # keep signals strictly within the background time range
+  keep = (times > background['minTime']) & (times < background['maxTime'] - 1)
+  order = np.argsort(times[keep], kind='stable')
+
+  return {'baryTime': times[keep][order], 'lat0': lats[keep][order], 'long0': longs[keep][order]}
+
+
+def mergeTriggers(background, injection):
+  '''
+  Inserts injected triggers into the sorted background trigger arrays.
+
+  Returns:  merged:      dictionary of merged trigger arrays
+            injected:    boolean array marking injected triggers
+            positions:   new index of each background trigger
+  '''
+
+  bgTimes = background['triggers']['baryTime']
+  nInj = len(injection['baryTime'])
+
+  # injected triggers go after background triggers at equal times
+  slots = np.searchsorted(bgTimes, injection['baryTime'], side='right') + np.arange(nInj)
+  injected = np.zeros(len(bgTimes) + nInj, dtype=bool)
+  injected[slots] = True
+
+  merged = {}
+  for key in ['baryTime', 'lat0', 'long0']:
+    merged[key] = np.empty(len(injected))
+    merged[key][~injected] = background['triggers'][key]
+    merged[key][injected] = injection[key]
+
+  return merged, injected, np.flatnonzero(~injected)
+
+
+def scoreInjection(background, injection, returnRows=False):
+  '''
+  Scores a segment with injected triggers, reusing the background search.
+
+  Params:     background:   background from prepareBackground
+              injection:    dictionary of injected trigger arrays
+
+  Optional:   returnRows:   boolean, also returns all template results in the
+                            format of likelihood, False by default
+
+  Returns:    result:       dictionary with maxLogLikelihood, the pair of the
+                            best template, whether that pair or one of its
+                            signal candidates is injected, and the numbers
+                            of rescored and new templates
+  '''
+
+  merged, injected, positions = mergeTriggers(background, injection)
+  n = len(merged['baryTime'])
+  totalTime = background['totalTime']
+  distanceWindow, timeWindow = background['distanceWindow'], background['timeWindow']
+  templates, points = background['templates'], background['points']
+
+  # background time locations an injected trigger may now be closest to
+  injTimes = injection['baryTime']
+  pointTime = templates['pointTime']
+  if len(injTimes):
+    after = np.searchsorted(injTimes, pointTime)
+    before = np.clip(after - 1, 0, len(injTimes) - 1)
+    after = np.clip(after, 0, len(injTimes) - 1)
+    injDistance = np.minimum(np.abs(injTimes[before] - pointTime), np.abs(injTimes[after] - pointTime))
+    affected = injDistance <= points['nearestDistance']
+  else:
+    affected = np.zeros(len(pointTime), dtype=bool)
+
+  # rescore affected locations against the merged triggers
+  owner = templates['pointTemplate']
+  nTemplates = len(templates['length'])
+  contributions, candidate, nearest = pointStatistics(totalTime, merged, pointTime[affected],
+                                                      templates['pointWindow'][affected],
+                                                      templates['midLat'][owner[affected]],
+                                                      templates['midLong'][owner[affected]], distanceWindow)
+  hitSums = background['hitSums'] + np.bincount(owner[affected], weights=contributions - points['contribution'][affected],
+                                                minlength=nTemplates)
+  candidates = background['candidates'] + np.bincount(owner[affected], weights=candidate.astype(int) - points['candidate'][affected],
+                                                      minlength=nTemplates).astype(int)
+
+  # injected candidates of background templates
+  injectedHits = np.bincount(owner[affected], weights=candidate & injected[nearest], minlength=nTemplates) > 0
+
+  # background templates in merged numbering
+  bgTemplates = dict(templates, i=positions[templates['i']], j=positions[templates['j']])
+  bgScores = templateScores(bgTemplates, hitSums, n, totalTime, timeWindow)
+
+  # new pairs with at least one injected trigger
+  pairI, pairJ = candidatePairs(merged, distanceWindow, background['minSeparation'], involving=injected)
+  newTemplates = pairTemplates(merged, pairI, pairJ, background['sequence'], background['maxSeq'],
+                               background['minDelta'], timeWindow, background['subsequences'])
+  newScores, newCandidates, _ = scoreTemplates(newTemplates, merged, distanceWindow, timeWindow, totalTime)
+
+  scores = np.concatenate([bgScores, newScores])
+  result = {'maxLogLikelihood': scores.max() if len(scores) else 0,
+            'rescoredTemplates': int(np.count_nonzero(np.bincount(owner[affected], minlength=nTemplates))),
+            'newTemplates': len(newScores),
+            'injectedTriggers': len(injTimes)}
+
+  if len(scores):
+    best = int(np.argmax(scores))
+    allTemplates = concatenateTemplates(bgTemplates, newTemplates)
+    result['bestPair'] = (int(allTemplates['i'][best]), int(allTemplates['j'][best]))
+    result['bestInjected'] = bool(best >= nTemplates or injectedHits[best])
+
+  if returnRows == True:
+
+    # order templates as likelihood visits them: by pair, then subsequence
+    allTemplates = concatenateTemplates(bgTemplates, newTemplates)
+    order = np.lexsort((np.arange(len(scores)), allTemplates['j'], allTemplates['i']))
+    rows = resultRows(allTemplates, scores, np.concatenate([candidates, newCandidates]))
+    result['rows'] = rows[order] if rows.ndim == 2 else rows
+    result['triggers'] = merged
+
+  return result
+
+
+# background held by each worker process of a campaign
+workerBackground = None
+
+
+def setWorkerBackground(background):
+  global workerBackground
+  workerBackground = background
+
+
+def injectionTask(task):
+  '''
+  Generates and scores one injection in a worker process.
+  '''
+
+  k, parameters, seed = task
+  rng = np.random.default_rng([seed, k])
+  injection = injectionTriggers(rng, workerBackground, **parameters)
+  result = scoreInjection(workerBackground, injection)
+
+  return dict(parameters, index=k, **result)
+
+
+def runInjectionCampaign(background, injectionParameters, nWorkers=1, seed=0):
+  '''
+  Scores many injections into the same background, in parallel. The
+  background is sent to each worker process once, and every injection is
+  reproducible from its seed and position in the list.
+
+  Params:     background:           background from prepareBackground
+              injectionParameters:  list of dictionaries of arguments of
+                                    injectionTriggers (delta, firstTime, lat,
+                                    long, skySpread, timeJitter, ...)
+
+  Optional:   nWorkers:             number of worker processes
+              seed:                 seed of the random generator
+
+  Returns:    results:              list of dictionaries of injection
+                                    parameters and results of scoreInjection
+  '''
+
+  tasks = [(k, parameters, seed) for k, parameters in enumerate(injectionParameters)]
+
+  if nWorkers == 1:
+    setWorkerBackground(background)
+    return [injectionTask(task) for task in tasks]
+
+  with ProcessPoolExecutor(max_workers=nWorkers, initializer=setWorkerBackground, initargs=(background,)) as pool:
+    return list(pool.map(injectionTask, tasks, chunksize=max(1, len(tasks) // (4 * nWorkers))))
+
+
+def recoveryEfficiency(results, parameter, bins, threshold):
+  '''
+  Fraction of injections recovered as a function of an injection parameter.
+  An injection counts as recovered if the maximum log likelihood of the
+  segment reaches the threshold and the best template involves an injected
+  trigger.
+
+  Params:   results:      list of results from runInjectionCampaign
+            parameter:    name of injection parameter to bin in
+            bins:         bin edges of parameter
+            threshold:    log likelihood detection threshold; maxima fall
+                          with the number of triggers in a segment, so it
+                          should come from background segments with as many
+                          triggers as the injected ones
+
+  Returns:  efficiency:   fraction of injections recovered in each bin
+            error:        binomial standard error of each fraction
+            counts:       number of injections in each bin
+  '''
+
+  values = np.array([r[parameter] for r in results], dtype=float)
+  recovered = np.array([r['maxLogLikelihood'] >= threshold and r.get('bestInjected', False) for r in results])
+
+  k = np.digitize(values, bins) - 1
+  inRange = (k >= 0) & (k < len(bins) - 1)
+  counts = np.bincount(k[inRange], minlength=len(bins) - 1)
+  found = np.bincount(k[inRange], weights=recovered[inRange], minlength=len(bins) - 1)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    efficiency = found / counts
+    error = np.sqrt(efficiency * (1 - efficiency) / counts)
+
+  return efficiency, error, counts
@@ -0,0 +1,417 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+# local imports
+import sequence_functions
+from load_files import dataLoader
+from engines import getEngine
+from result_store import appendResults
+
+# The queue lives entirely in a shared directory so that no service has to run
+# on the cluster. Its layout is:
+#
+#   queueDir/manifest.json              search parameters and list of segments
+#   queueDir/segments/<name>.csv        trigger data of each segment
+#   queueDir/locks/<name>.lease.<n>     n-th lease taken out on a segment
+#   queueDir/results/<name>.npz         per-segment likelihood results
+#
+# Leases are never overwritten by other workers: a worker claims a segment by
+# atomically creating the next numbered lease file, which only succeeds for one
+# worker. A lease whose expiry time has passed may be superseded by creating
+# the following lease number, so segments held by dead workers are picked up.
+
+
+def writeManifest(queueDir, bgslices, fgslices, distanceWindow, timeWindow, sequence, maxSeq, leaseTime=3600, engine='reference'):
+  '''
+  Sets up the queue directory with a manifest and one file per data segment.
+
+  Params:     queueDir:        shared directory used as job queue
+              bgslices:        list of background data segments
+              fgslices:        list of foreground data segments
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: getPrimes), must be
+                               defined in sequence_functions
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   leaseTime:       seconds a claimed segment is reserved for a
+                               worker before other workers may take it over
+              engine:          name of search engine, see engines.ENGINES
+
+  Returns:    manifest:        dictionary written to manifest.json
+  '''
+
+  # create directory structure
+  for sub in ['segments', 'locks', 'results']:
+    os.makedirs(os.path.join(queueDir, sub), exist_ok=True)
+
+  # the sequence function has to be found again by name on every node
+  if getattr(sequence_functions, sequence.__name__, None) is not sequence:
+    raise ValueError('Sequence function must be defined in sequence_functions')
+
+  # write segments to file, keeping track of their type
+  segments = []
+  for kind, slices in [('background', bgslices), ('foreground', fgslices)]:
+    for k, sl in enumerate(slices):
+      name = '{0}_{1:05d}'.format(kind, k)
+      sl.to_csv(os.path.join(queueDir, 'segments', name + '.csv'), index=False)
+      segments.append({'name': name, 'kind': kind})
+
+  # store search parameters
+  manifest = {'distanceWindow': distanceWindow, 'timeWindow': timeWindow,
+              'sequence': sequence.__name__, 'maxSeq': maxSeq,
+              'leaseTime': leaseTime, 'engine': engine, 'segments': segments}
+
+  # write manifest last so that workers never see a half-built queue
+  atomicWrite(os.path.join(queueDir, 'manifest.json'), json.dumps(manifest, indent=2))
+
+  return manifest
+
+
+def readManifest(queueDir):
+  '''
+  Reads the manifest of a queue directory.
+
+  Params:   queueDir:   shared directory used as job queue
+  Returns:  manifest:   dictionary of search parameters and segments
+  '''
+
+  with open(os.path.join(queueDir, 'manifest.json')) as f:
+    return json.load(f)
+
+
+def atomicWrite(path, text):
+  '''
+  Writes text to a file such that readers only ever see the complete file.
+
+  Params:   path:   file to write
+            text:   file content
+  '''
+
+  tmpPath = '{0}.tmp.{1}.{2}'.format(path, socket.gethostname(), os.getpid())
+  with open(tmpPath, 'w') as f:
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmpPath, path)
+
+
+def resultPath(queueDir, name):
+  return os.path.join(queueDir, 'results', name + '.npz')
+
+
+def currentLease(queueDir, name):
+  '''
+  Finds the most recent lease on a segment.
+
+  Params:   queueDir:   shared directory used as job queue
+            name:       segment name
+
+  Returns:  number:     lease number, -1 if segment has never been claimed
+            lease:      lease content (worker and expiry), None if the lease
+                        file has only just been created and is still empty
+  '''
+
+  prefix = name + '.lease.'
+  numbers = [int(f[len(prefix):]) for f in os.listdir(os.path.join(queueDir, 'locks'))
+             if f.startswith(prefix) and f[len(prefix):].isdigit()]
+
+  if not numbers:
+    return -1, None
+
+  number = max(numbers)
+  path = leasePath(queueDir, name, number)
+  try:
+    with open(path) as f:
+      lease = json.loads(f.read())
+  except (ValueError, FileNotFoundError):
+    lease = None
+
+    # a lease file that stays empty belongs to a worker that died while
+    # claiming the segment
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) > 60:
+      lease = {'worker': None, 'expires': 0}
+
+  return number, lease
+
+
+def leasePath(queueDir, name, number):
+  return os.path.join(queueDir, 'locks', '{0}.lease.{1}'.format(name, number))
+
+
+def createLease(queueDir, name, number, workerId, leaseTime):
+  '''
+  Creates a lease. Creation is atomic, so only one worker can hold a given
+  lease number.
+
+  Params:   queueDir:   shared directory used as job queue
+            name:       segment name
+            number:     lease number
+            workerId:   identifier of worker taking out the lease
+            leaseTime:  seconds until lease expires
+
+  Returns:  boolean:    True if lease was obtained
+  '''
+
+  # fails if another worker was faster
+  try:
+    fd = os.open(leasePath(queueDir, name, number), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+  except FileExistsError:
+    return False
+
+  with os.fdopen(fd, 'w') as f:
+    f.write(json.dumps({'worker': workerId, 'expires': time.time() + leaseTime}))
+
+  return True
+
+
+def renewLease(queueDir, name, number, workerId, leaseTime):
+  '''
+  Extends the expiry time of a lease held by this worker.
+  '''
+
+  atomicWrite(leasePath(queueDir, name, number),
+              json.dumps({'worker': workerId, 'expires': time.time() + leaseTime}))
+
+
+def claimSegment(queueDir, workerId, leaseTime):
+  '''
+  Claims the next unfinished segment that is not held by a valid lease.
+
+  Params:   queueDir:   shared directory used as job queue
+            workerId:   identifier of worker claiming the segment
+            leaseTime:  seconds until lease expires
+
+  Returns:  name:       name of claimed segment, None if nothing is available
+            number:     lease number held on the segment
+  '''
+
+  for segment in readManifest(queueDir)['segments']:
+    name = segment['name']
+
+    # skip finished segments
+    if os.path.exists(resultPath(queueDir, name)):
+      continue
+
+    # skip segments held by a lease that is still valid; empty lease files
+    # belong to a worker that is just claiming the segment
+    number, lease = currentLease(queueDir, name)
+    if number >= 0 and (lease is None or lease['expires'] > time.time()):
+      continue
+
+    # try to take out the next lease
+    if createLease(queueDir, name, number + 1, workerId, leaseTime):
+      return name, number + 1
+
+  return None, -1
+
+
+def pendingSegments(queueDir):
+  '''
+  Returns names of all segments without result files.
+  '''
+
+  return [s['name'] for s in readManifest(queueDir)['segments']
+          if not os.path.exists(resultPath(queueDir, s['name']))]
+
+
+def heartbeat(queueDir, name, number, workerId, leaseTime, stop):
+  '''
+  Renews a lease periodically until stop is set, so that long segments are not
+  taken over while their worker is still alive.
+  '''
+
+  while not stop.wait(leaseTime / 3):
+    renewLease(queueDir, name, number, workerId, leaseTime)
+
+
+def runWorker(queueDir, workerId=None, pollInterval=10, verbose=False):
+  '''
+  Processes segments from the queue until every segment has a result.
+
+  Params:     queueDir:       shared directory used as job queue
+
+  Optional:   workerId:       identifier of this worker, defaults to host name
+                              and process id
+              pollInterval:   seconds to wait before checking again for expired
+                              leases once all segments are claimed
+              verbose:        boolean, prints status updates, False by default
+
+  Returns:    processed:      list of segment names processed by this worker
+  '''
+
+  if workerId is None:
+    workerId = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+  manifest = readManifest(queueDir)
+  sequence = getattr(sequence_functions, manifest['sequence'])
+  search = getEngine(manifest.get('engine', 'reference'))
+  leaseTime = manifest['leaseTime']
+
+  processed = []
+  while True:
+
+    name, number = claimSegment(queueDir, workerId, leaseTime)
+
+    # nothing to claim: either finished, or wait for leases to expire
+    if name is None:
+      if not pendingSegments(queueDir):
+        return processed
+      time.sleep(pollInterval)
+      continue
+
+    if verbose == True:
+      print('{0}: running on segment {1} (lease {2})'.format(workerId, name, number))
+
+    # keep lease alive while searching
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(queueDir, name, number, workerId, leaseTime, stop), daemon=True)
+    beat.start()
+
+    try:
+      data = pd.read_csv(os.path.join(queueDir, 'segments', name + '.csv'))
+      L, maxL = search(data, manifest['distanceWindow'], manifest['timeWindow'],
+                           sequence, manifest['maxSeq'], plot=False, verbose=False)
+    finally:
+      stop.set()
+      beat.join()
+
+    # write results atomically; a duplicate run of the same segment by a
+    # worker that lost its lease writes identical results
+    tmpPath = '{0}.tmp.{1}.npz'.format(resultPath(queueDir, name), workerId)
+    np.savez(tmpPath, logLikelihoods=L, maxLogLikelihood=maxL)
+    os.replace(tmpPath, resultPath(queueDir, name))
+
+    processed.append(name)
+
+
+def mergeResults(queueDir, storeDir=None):
+  '''
+  Collects per-segment results into the max log likelihood distribution.
+
+  Params:     queueDir:           shared directory used as job queue
+
+  Optional:   storeDir:           directory of columnar result store to write
+                                  all templates to, with background and
+                                  foreground segments in subdirectories
+
+  Returns:    maxLogLikelihoods:  maximum log likelihood of each finished
+                                  background segment
+              fgMaxLs:            maximum log likelihood of each finished
+                                  foreground segment
+              missing:            names of segments without results
+  '''
+
+  maxLogLikelihoods = []
+  fgMaxLs = []
+  missing = []
+
+  for segment in readManifest(queueDir)['segments']:
+    path = resultPath(queueDir, segment['name'])
+
+    if not os.path.exists(path):
+      missing.append(segment['name'])
+      continue
+
+    with np.load(path) as results:
+      maxL = float(results['maxLogLikelihood'])
+
+      # segment number is the suffix of its name
+      if storeDir is not None:
+        appendResults(os.path.join(storeDir, segment['kind']), int(segment['name'].split('_')[-1]),
+                      results['logLikelihoods'], maxL)
+
+    if segment['kind'] == 'background':
+      maxLogLikelihoods.append(maxL)
+    else:
+      fgMaxLs.append(maxL)
+
+  return np.array(maxLogLikelihoods), np.array(fgMaxLs), missing
+
+
+def runLocalWorkers(queueDir, nWorkers, pollInterval=1):
+  '''
+  Runs several worker processes on this machine, each standing in for a node.
+
+  Params:     queueDir:       shared directory used as job queue
+              nWorkers:       number of worker processes
+
+  Optional:   pollInterval:   seconds between checks for expired leases
+  '''
+
+  workers = [multiprocessing.Process(target=runWorker, args=(queueDir,),
+                                     kwargs={'workerId': 'local-{0}'.format(k), 'pollInterval': pollInterval})
+             for k in range(nWorkers)]
+
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Run likelihood search on segments through a shared directory queue.')
+  sub = parser.add_subparsers(dest='command', required=True)
+
+  init = sub.add_parser('init', help='write manifest and segments')
+  init.add_argument('queueDir')
+  init.add_argument('fgfile')
+  init.add_argument('bgfile')
+  init.add_argument('--maxSeq', type=int, default=5)
+  init.add_argument('--distanceWindow', type=float, default=100)
+  init.add_argument('--timeWindow', type=float, default=500)
+  init.add_argument('--sequence', default='getPrimes')
+  init.add_argument('--leaseTime', type=float, default=3600)
+  init.add_argument('--engine', default='reference')
+
+  work = sub.add_parser('work', help='process segments until queue is empty')
+  work.add_argument('queueDir')
+  work.add_argument('--pollInterval', type=float, default=10)
+
+  local = sub.add_parser('local', help='run several workers on this machine')
+  local.add_argument('queueDir')
+  local.add_argument('nWorkers', type=int)
+
+  merge = sub.add_parser('merge', help='collect results and plot distribution')
+  merge.add_argument('queueDir')
+  merge.add_argument('--plot', action='store_true')
+  merge.add_argument('--storeDir', default=None)
+
+  args = parser.parse_args()
+
+  if args.command == 'init':
+    fgslices, bgslices = dataLoader(args.fgfile, args.bgfile)
+    writeManifest(args.queueDir, bgslices, fgslices[:1], args.distanceWindow, args.timeWindow,
+                  getattr(sequence_functions, args.sequence), args.maxSeq, leaseTime=args.leaseTime,
+                  engine=args.engine)
+
+  elif args.command == 'work':
+    runWorker(args.queueDir, pollInterval=args.pollInterval, verbose=True)
+
+  elif args.command == 'local':
+    runLocalWorkers(args.queueDir, args.nWorkers)
+
+  elif args.command == 'merge':
+    maxLogLikelihoods, fgMaxLs, missing = mergeResults(args.queueDir, storeDir=args.storeDir)
+    if missing:
+      print('Segments without results:', len(missing))
+
+    # nothing to summarise until a background segment has finished
+    if len(maxLogLikelihoods) == 0:
+      print('No background segment has finished yet, {0} segments without results'.format(len(missing)))
+    else:
+      print('Absolute maximum background:', max(maxLogLikelihoods))
+    print('Foreground:', fgMaxLs)
+
+    if args.plot and len(maxLogLikelihoods) > 0:
+      from plotting_functions import plotStatHist
+      plotStatHist(maxLogLikelihoods, fgMaxLs)
@@ -3,15 +3,44 @@ import math
 from scipy import stats
 
 # local imports
-from coordinate_conversions import solarSystemBarycentre, angularMidpoint
+from coordinate_conversions import solarSystemBarycentre, angularMidpoint, skyCoordinates
 from similarity_checks import similarityDistance
-from time_functions import timeLocations
-from trigger_search import search
+from time_functions import timeLocations, subsequenceTable, admissibleSubsequences, firstPartners
+from trigger_search import search, occupancyMap, hitReach, reachableTriggers
 from statistics import combinations
 from plotting_functions import plotTimeLocs, histListLengths
 
 
-def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=None, paramMidpoints=None, paramWindows=None, plot=False, verbose=False):
+def prepareSegment(dataframe, verbose=False):
+  '''
+  Prepares a data segment for the search: converts times to the Solar System
+  Barycentre, sorts triggers by time and adds sky coordinates. This does not
+  depend on any search parameters, so it can be done ahead of the search.
+
+  Params:     dataframe:   background or foreground data as pandas dataframe
+
+  Optional:   verbose:     boolean, prints sorted dataframe, False by default
+
+  Returns:    df:          prepared dataframe
+  '''
+
+  # rescale all times to Solar System Barycentre
+  df = solarSystemBarycentre(dataframe)
+
+  # sort data by time for clear forward and backward directions for location
+  # search
+  df = df.sort_values(by='baryTime', ignore_index=True)
+  if verbose == True:
+    print('Sorted dataframe:\n', df)
+
+  # calculate and store longitude and latitude of each point by converting
+  # phi to longitude and theta to latitude
+  df = skyCoordinates(df)
+
+  return df
+
+
+def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=None, paramMidpoints=None, paramWindows=None, minDelta=None, maxTemplateLength=None, prepared=False, prefilter=False, minHits=1, bandWidth=None, plot=False, verbose=False):
   '''
   Function defines trigger pairs and loops through rest of dataframe
   to determine triggers that are in sequence.
@@ -29,6 +58,26 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
               paramWindows:    allowed uncertainty windows for each parameter,
                                stored as a dataframe with entries corresponding
                                to given params
+              minDelta:        minimum sequence unit, one 250th of the segment
+                               duration by default (see cost_model for picking
+                               it from a compute budget)
+              maxTemplateLength: maximum number of time locations per template
+                               besides those between the trigger pair, no limit
+                               by default
+              prepared:        boolean, True if dataframe has already been
+                               passed through prepareSegment, False by default
+              prefilter:       boolean, only searches time locations with a
+                               trigger in reach according to an occupancy map
+                               (see trigger_search.occupancyMap), which loses
+                               nothing since all other locations cannot find
+                               a signal candidate, False by default
+              minHits:         smallest number of time locations with a
+                               trigger in reach for a template to be searched
+                               with prefilter; others get the log likelihood
+                               of a template without candidates; 1, the
+                               default, loses nothing
+              bandWidth:       width of latitude bands of the occupancy map in
+                               degrees, distanceWindow by default
               plot:            boolean, determines if lists necessary for plots
                                need to be filled, False by default
               verbose:         boolean, prints status updates to simplify debugging,
@@ -50,19 +99,11 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
     # initialise list plotting variable, if requested
     plotList = []
 
-  # rescale all times to Solar System Barycentre
-  df = solarSystemBarycentre(dataframe)
-
-  # sort data by time for clear forward and backward directions for location
-  # search
-  df = df.sort_values(by='baryTime', ignore_index=True)
-  if verbose == True:
-    print('Sorted dataframe:\n', df)
-
-  # calculate and store longitude and latitude of each point by converting
-  # phi to longitude and theta to latitude
-  df['long0'] = np.where(df['phi0'] > 180, df['phi0'] - 360, df['phi0'])
-  df['lat0'] = 90 - df['theta0']
+  # barycentre and sort data, unless this has been done beforehand
+  if prepared == True:
+    df = dataframe
+  else:
+    df = prepareSegment(dataframe, verbose=verbose)
 
   # minimum and maximum global time
   minTime = df['baryTime'].min()
@@ -71,7 +112,8 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
   print('Total time:', totalTime / (24 * 3600), 'days')
 
   # find minimum sequence step length for computational feasibility
-  minDelta = totalTime / 250
+  if minDelta is None:
+    minDelta = totalTime / 250
   if verbose == True:
     print('Min delta:', minDelta)
 
@@ -79,11 +121,26 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
   # each time); two true triggers are assigned likelihoods later, hence the -2
   logLikelihoodInit = - len(df.index - 2) * math.log(totalTime)
 
+  # subsequences that can join a trigger pair
+  subsequences = subsequenceTable(sequence, maxSeq)
+
+  # a pair can only produce templates if its separation is above minDelta
+  # times the shortest subsequence, so find the first partner of each trigger
+  # for which this holds
+  times = df['baryTime'].to_numpy(dtype=float)
+  minSeparation = minDelta * min(entry[2] for entry in subsequences)
+  partners = firstPartners(times, minSeparation)
+
+  # count triggers in time bins and latitude bands once, if prompted
+  if prefilter == True:
+    occupancy = occupancyMap({'baryTime': times, 'lat0': df['lat0'].to_numpy(dtype=float)}, timeWindow,
+                             bandWidth=bandWidth if bandWidth is not None else distanceWindow)
+
   # loop over rows (triggers)
   for i in range(len(df.index)-1):
 
-    # loop over every other row (trigger)
-    for j in range(i+1, len(df.index)):
+    # loop over every other row (trigger) far enough away in time
+    for j in range(partners[i], len(df.index)):
 
       if verbose == True:
         print()
@@ -105,9 +162,12 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
         t1Time = t1['baryTime']
         t2Time = t2['baryTime']
 
-        # find time locations to search in
+        # find time locations to search in, only trying subsequences that
+        # give a large enough sequence unit
         timeLocs, timeWindows, sequenceLocs = timeLocations(t1Time, t2Time, minTime, maxTime, sequence, maxSeq,
-                                                            minDelta, timeWindow, plot=plot, verbose=verbose)
+                                                            minDelta, timeWindow, maxLength=maxTemplateLength,
+                                                            subsequences=admissibleSubsequences(subsequences, t2Time - t1Time, minDelta),
+                                                            plot=plot, verbose=verbose)
 
         # find log likelihood for intial trigger pair
         logLikelihoodT1 = stats.norm.logpdf(t1Time, loc=t1Time, scale=timeWindow)
@@ -124,9 +184,18 @@ def likelihood(dataframe, distanceWindow, timeWindow, sequence, maxSeq, params=N
           # initialise log likelihood value with background
           logLikelihoodStart = logLikelihoodInit + logLikelihoodT1 + logLikelihoodT2
 
+          # only search time locations with a trigger in reach, if prompted
+          searchList, searchWindows = seqList, seqWindows
+          if prefilter == True:
+            reachable = reachableTriggers(occupancy, np.array(seqList), hitReach(np.array(seqWindows), totalTime),
+                                          midDist['lat0'], distanceWindow) > 0
+            searchList, searchWindows = np.array(seqList)[reachable], np.array(seqWindows)[reachable]
+            if len(searchList) < minHits:
+              searchList, searchWindows = [], []
+
           # search for triggers in each sequence list
           logLikelihood, signalCandidates = search(logLikelihoodStart, totalTime, df,
-                                                   seqList, seqWindows, midDist, distanceWindow,
+                                                   searchList, searchWindows, midDist, distanceWindow,
                                                    params=params, paramMidpoints=paramMidpoints,
                                                    paramWindows=paramWindows, verbose=verbose)
 
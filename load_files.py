@@ -22,6 +22,13 @@ def dataLoader(fgfile, bgfile):
       if 15 < totalTime < 35:
         trueBgSlices.append(sl)
 
+    # load foreground data
+    fgslices = fgDataLoader(fgfile)
+
+    return fgslices, trueBgSlices
+
+
+def fgDataLoader(fgfile):
     # load foreground data
     fgdata = pd.read_csv(fgfile)
 
@@ -29,4 +36,52 @@ def dataLoader(fgfile, bgfile):
     fgdata = fgdata.head(120)
     fgslices = np.array_split(fgdata, 4)
 
-    return fgslices, trueBgSlices
+    return fgslices
+
+
+def bgSegmentReader(bgfile, nTriggers=15000, nSlices=500):
+    '''
+    Reads background segments from file one at a time, so that reading can
+    overlap with the search. Segments are the same as those of dataLoader as
+    long as the file holds at least nTriggers triggers.
+
+    Params:     bgfile:      background data file
+
+    Optional:   nTriggers:   number of triggers to read from the start of file
+                nSlices:     number of equal parts to split triggers into
+
+    Returns:    generator of (segment number, dataframe) for every segment
+                that is sufficiently long
+    '''
+
+    # slice sizes as given by np.array_split
+    sizes = [nTriggers // nSlices + 1] * (nTriggers % nSlices) + [nTriggers // nSlices] * (nSlices - nTriggers % nSlices)
+
+    with pd.read_csv(bgfile, nrows=nTriggers, iterator=True) as reader:
+      for k, size in enumerate(sizes):
+        try:
+          sl = reader.get_chunk(size)
+        except StopIteration:
+          return
+
+        # only keep data chunks that are sufficiently long
+        totalTime = (sl['time0'].max() - sl['time0'].min()) / (3600 * 24)
+        if 15 < totalTime < 35:
+          yield k, sl
+
+
+def numberedSegments(segments):
+    '''
+    Numbers data segments, accepting both a list of segments and segments
+    already numbered by a reader such as bgSegmentReader.
+
+    Params:     segments:    list of data segments, or iterable of (segment
+                             number, dataframe)
+
+    Returns:    generator of (segment number, dataframe)
+    '''
+
+    for k, segment in enumerate(segments):
+        if isinstance(segment, tuple):
+            k, segment = segment
+        yield k, segment
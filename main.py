@@ -1,8 +1,11 @@
 # local imports
-from load_files import dataLoader
-from likelihood_calculations import likelihood
-from plotting_functions import plotStatHist
+from load_files import fgDataLoader, bgSegmentReader
+from engines import getEngine
+from pipeline import runPipeline
+from plotting_functions import plotAccumulatedHist
 from sequence_functions import getPrimes
+from result_store import appendResults
+from background_accumulator import initAccumulator, updateAccumulator, significance
 
 # TODO: make this file less messy, clean up function calls, correct data segments
 
@@ -10,35 +13,52 @@ from sequence_functions import getPrimes
 fgfile = "GW_data/wave_O3_K99_C01_LH_BurstLF_BKG_run1_M2_V_hvetoLH_foreground.csv"
 bgfile = "GW_data/wave_O3_K99_C01_LH_BurstLF_BKG_run1_M2_V_hvetoLH_background.csv"
 
-# load data
-fgslices, bgslices = dataLoader(fgfile, bgfile)
-
 # test parameters
 maxSeq = 5
 distanceWindow = 100 # degrees
 timeWindow = 500 # seconds, around 8 minutes
 
-# initialise storage lists
-logLikelihoods = []
-maxLogLikelihoods = []
+# search engine, 'reference', 'reference-prefilter' or 'fast' (check with
+# engines.validateEngines)
+engine = 'reference'
+
+# directories of columnar result stores, read with result_store.openResultStore
+bgStore = "results/background"
+fgStore = "results/foreground"
+
+# initialise background summaries, memory does not grow with segments
+bgSummary = initAccumulator()
 
-# loop over data segments
-for i in range(len(bgslices)):
 
+def writeSegment(k, df, L, maxL):
     # print progress
-    print('Running on data segment {0}...'.format(i+1))
+    print('Finished data segment {0}...'.format(k+1))
+
+    # save to result store and background summaries
+    appendResults(bgStore, k, L, maxL)
+    liveTime = df['time0'].max() - df['time0'].min()
+    updateAccumulator(bgSummary, L, maxL, liveTime=liveTime)
+
+
+# guard needed as segments are prepared in worker processes
+if __name__ == '__main__':
 
-    # call algorithm
-    L, maxL = likelihood(bgslices[i], distanceWindow, timeWindow, getPrimes, maxSeq, plot=False, verbose=False)
+    # loop over data segments, reading and barycentring the next segments and
+    # writing results of the previous ones while searching
+    runPipeline(bgSegmentReader(bgfile), distanceWindow, timeWindow, getPrimes, maxSeq, writeSegment,
+                engine=engine, plot=False, verbose=False)
 
-    # save to lists
-    logLikelihoods.append(L)
-    maxLogLikelihoods.append(maxL)
+    # foreground test run
+    fgslices = fgDataLoader(fgfile)
+    fgL, fgMaxL = getEngine(engine)(fgslices[0], distanceWindow, timeWindow, getPrimes, maxSeq, plot=False, verbose=False)
+    appendResults(fgStore, 0, fgL, fgMaxL)
 
-# foreground test run
-fgL, fgMaxL = likelihood(fgslices[0], distanceWindow, timeWindow, getPrimes, maxSeq, plot=False, verbose=False)
+    # plot histogram
+    plotAccumulatedHist(bgSummary, fgMaxL)
+    print('Absolute maximum background:', max(bgSummary['topMaxima']))
+    print('Foreground:', fgMaxL)
 
-# plot histogram
-plotStatHist(maxLogLikelihoods, fgMaxL)
-print('Absolute maximum background:', max(maxLogLikelihoods))
-print('Foreground:', fgMaxL)
+    # significance of foreground against background
+    fgSignificance = significance(bgSummary, fgMaxL)
+    print('p-value:', fgSignificance['pValue'])
+    print('False alarm rate:', fgSignificance['falseAlarmRate'], 'per second')
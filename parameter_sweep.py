@@ -0,0 +1,153 @@
+import math
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# local imports
+from load_files import numberedSegments
+from coordinate_conversions import greatCircleDistances
+from likelihood_calculations import prepareSegment
+from time_functions import subsequenceTable
+from trigger_search import nearestTriggers
+from fast_search import segmentArrays, segmentTimes, candidatePairs, pairTemplates, templateScores
+
+# A sweep evaluates every combination of maxSeq, distanceWindow and
+# timeWindow on the same segments, building each intermediate result only
+# once at the level it depends on:
+#   segment:         barycentre times, sorting, sky coordinates
+#   maxSeq:          subsequence table, candidate pairs for the largest
+#                    distanceWindow, templates with windows for a unit time
+#                    uncertainty (windows scale linearly with timeWindow),
+#                    closest trigger of each time location and its distance
+#                    to the template midpoint, distance of each pair
+#   grid point:      sky cuts on pairs and locations, Gaussian statistics and
+#                    template scores, which are cheap array operations
+
+
+def sweepArtifacts(triggers, sequence, maxSeq, maxDistanceWindow, minDelta):
+  '''
+  Builds everything for one maxSeq that does not depend on distanceWindow or
+  timeWindow.
+
+  Params:   triggers:           dictionary of trigger arrays
+            sequence:           sequence function (e.g.: primes, Fibonacci, ...)
+            maxSeq:             max number of steps before sequence restarts
+            maxDistanceWindow:  largest distanceWindow of the grid
+            minDelta:           minimum sequence unit
+
+  Returns:  artifacts:          dictionary of templates, pair distances and
+                                closest triggers of time locations
+  '''
+
+  subsequences = subsequenceTable(sequence, maxSeq)
+  minSeparation = minDelta * min(entry[2] for entry in subsequences)
+
+  # pairs and templates for the widest sky cut, with unit time uncertainty
+  pairI, pairJ = candidatePairs(triggers, maxDistanceWindow, minSeparation)
+  templates = pairTemplates(triggers, pairI, pairJ, sequence, maxSeq, minDelta, 1.0, subsequences)
+  owner = templates['pointTemplate']
+
+  # closest trigger of each time location and its sky distance to the
+  # midpoint of the template's pair
+  nearest = nearestTriggers(triggers['baryTime'], templates['pointTime'])
+  pointDistance = greatCircleDistances(triggers['lat0'][nearest], triggers['long0'][nearest],
+                                       templates['midLat'][owner], templates['midLong'][owner])
+
+  return {'templates': templates,
+          'pairDistance': greatCircleDistances(triggers['lat0'][templates['i']], triggers['long0'][templates['i']],
+                                               triggers['lat0'][templates['j']], triggers['long0'][templates['j']]),
+          'nearestTime': triggers['baryTime'][nearest],
+          'pointDistance': pointDistance}
+
+
+def evaluateGridPoint(artifacts, distanceWindow, timeWindow, numberOfTriggers, totalTime):
+  '''
+  Maximum log likelihood of a segment for one distanceWindow and timeWindow
+  from the artifacts of its maxSeq.
+
+  Returns:  maxLogLikelihood:   maximum log likelihood, 0 if no template
+                                is left, as in likelihood
+            numberOfTemplates:  number of templates searched
+  '''
+
+  templates = artifacts['templates']
+  owner = templates['pointTemplate']
+
+  # templates whose pair passes the sky cut
+  keep = artifacts['pairDistance'] <= distanceWindow
+  if not keep.any():
+    return 0, 0
+
+  # Gaussian statistic and sky cut of every time location
+  gaussianStatistic = stats.norm.logpdf(artifacts['nearestTime'], loc=templates['pointTime'],
+                                        scale=timeWindow * templates['pointWindow'])
+  logTotalTime = math.log(totalTime)
+  candidate = (artifacts['pointDistance'] <= distanceWindow) & (gaussianStatistic > - logTotalTime)
+  contributions = np.where(candidate, gaussianStatistic + logTotalTime, 0.0)
+
+  hitSums = np.bincount(owner, weights=contributions, minlength=len(keep))
+  scores = templateScores(templates, hitSums, numberOfTriggers, totalTime, timeWindow)
+
+  return scores[keep].max(), int(np.count_nonzero(keep))
+
+
+def sweepSegment(df, sequence, grid, minDelta=None):
+  '''
+  Evaluates all grid points on one prepared segment.
+
+  Params:     df:         segment passed through prepareSegment
+              sequence:   sequence function (e.g.: primes, Fibonacci, ...)
+              grid:       dictionary with lists of 'maxSeq', 'distanceWindow'
+                          and 'timeWindow' values
+
+  Optional:   minDelta:   minimum sequence unit, one 250th of the segment
+                          duration by default
+
+  Returns:    rows:       list of dictionaries, one per grid point
+  '''
+
+  triggers = segmentArrays(df)
+  _, _, totalTime = segmentTimes(triggers)
+  if minDelta is None:
+    minDelta = totalTime / 250
+  n = len(triggers['baryTime'])
+
+  rows = []
+  for maxSeq in grid['maxSeq']:
+    artifacts = sweepArtifacts(triggers, sequence, maxSeq, max(grid['distanceWindow']), minDelta)
+
+    for distanceWindow, timeWindow in itertools.product(grid['distanceWindow'], grid['timeWindow']):
+      maxL, numberOfTemplates = evaluateGridPoint(artifacts, distanceWindow, timeWindow, n, totalTime)
+      rows.append({'maxSeq': maxSeq, 'distanceWindow': distanceWindow, 'timeWindow': timeWindow,
+                   'maxLogLikelihood': maxL, 'templates': numberOfTemplates})
+
+  return rows
+
+
+def runSweep(segments, sequence, grid, prepared=False, minDelta=None):
+  '''
+  Runs a parameter sweep over many segments.
+
+  Params:     segments:   list of data segments, or iterable of (segment
+                          number, dataframe)
+              sequence:   sequence function (e.g.: primes, Fibonacci, ...)
+              grid:       dictionary with lists of 'maxSeq', 'distanceWindow'
+                          and 'timeWindow' values
+
+  Optional:   prepared:   boolean, True if segments have already been passed
+                          through prepareSegment, False by default
+              minDelta:   minimum sequence unit, one 250th of each segment's
+                          duration by default
+
+  Returns:    table:      dataframe of maximum log likelihoods with one row
+                          per segment and grid point
+  '''
+
+  rows = []
+  for k, segment in numberedSegments(segments):
+    df = segment if prepared == True else prepareSegment(segment)
+    for row in sweepSegment(df, sequence, grid, minDelta=minDelta):
+      rows.append(dict(segment=k, **row))
+
+  return pd.DataFrame(rows)
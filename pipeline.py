@@ -0,0 +1,132 @@
+import queue
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+# local imports
+from likelihood_calculations import prepareSegment
+from engines import getEngine
+
+
+def runPipeline(segments, distanceWindow, timeWindow, sequence, maxSeq, writer, engine='reference', prefetch=2, nPrepare=1, writeQueueSize=2, **kwargs):
+  '''
+  Runs the likelihood search over many segments in four overlapping stages:
+  a reader thread pulls upcoming segments from segments, worker processes
+  barycentre them, the calling process searches the current segment, and a
+  writer thread handles finished results. Each stage blocks once the next one
+  falls behind, so at most prefetch read and prefetch prepared segments and
+  writeQueueSize results are held in memory.
+
+  Params:     segments:        iterable of (segment number, dataframe), e.g.
+                               load_files.bgSegmentReader; it is read in a
+                               separate thread, only as fast as segments are
+                               searched
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+              writer:          function called as writer(k, df, L, maxL) with
+                               segment number, prepared dataframe and results
+                               of likelihood, run in a separate thread
+
+  Optional:   engine:          search engine, see engines.ENGINES
+              prefetch:        number of segments read, and number of segments
+                               prepared, ahead of the search
+              nPrepare:        number of processes preparing segments
+              writeQueueSize:  number of results waiting to be written
+              kwargs:          further arguments passed on to likelihood
+
+  Returns:    numberOfSegments:  number of segments searched
+  '''
+
+  search = getEngine(engine)
+
+  # write stage, consumes results until it receives None
+  writeQueue = queue.Queue(maxsize=writeQueueSize)
+  errors = []
+
+  def writeStage():
+    while True:
+      item = writeQueue.get()
+      if item is None:
+        return
+
+      # keep draining the queue after an error so the search never blocks
+      if not errors:
+        try:
+          writer(*item)
+        except Exception as e:
+          errors.append(e)
+
+  writeThread = threading.Thread(target=writeStage, daemon=True)
+  writeThread.start()
+
+  # read stage, pulls segments from the reader and ends with None; it gives
+  # up once the search has stopped so that it never blocks on a full queue
+  readQueue = queue.Queue(maxsize=prefetch)
+  stopped = threading.Event()
+
+  def putUnlessStopped(item):
+    while not stopped.is_set():
+      try:
+        readQueue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def readStage():
+    try:
+      for item in segments:
+        if not putUnlessStopped(item):
+          return
+    except Exception as e:
+      errors.append(e)
+    putUnlessStopped(None)
+
+  readThread = threading.Thread(target=readStage, daemon=True)
+  readThread.start()
+
+  numberOfSegments = 0
+  exhausted = []
+
+  try:
+    with ProcessPoolExecutor(max_workers=nPrepare) as pool:
+
+      # prepare segments ahead of the search, in order
+      pending = collections.deque()
+
+      def prepareNext():
+        if exhausted:
+          return
+        item = readQueue.get()
+        if item is None:
+          exhausted.append(True)
+        else:
+          pending.append((item[0], pool.submit(prepareSegment, item[1])))
+
+      for _ in range(prefetch):
+        prepareNext()
+
+      # search stage
+      while pending and not errors:
+        k, future = pending.popleft()
+        df = future.result()
+        prepareNext()
+
+        L, maxL = search(df, distanceWindow, timeWindow, sequence, maxSeq, prepared=True, **kwargs)
+
+        # blocks if the writer is behind
+        writeQueue.put((k, df, L, maxL))
+        numberOfSegments += 1
+
+  finally:
+    stopped.set()
+    readThread.join()
+    writeQueue.put(None)
+    writeThread.join()
+
+  if errors:
+    raise errors[0]
+
+  return numberOfSegments
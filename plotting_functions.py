@@ -94,4 +94,32 @@ def plotStatHist(maxLogLikelihoods, fgLogLikelihood):
   # plot configs
   plt.xlabel('Log likelihood', fontsize=20)
   plt.ylabel('Number of events', fontsize=20)
-  plt.show()
\ No newline at end of file
+  plt.show()
+
+def plotAccumulatedHist(acc, fgLogLikelihood):
+  '''
+  Plots the histogram of background maximum log likelihoods kept by a
+  background accumulator, together with the foreground value.
+
+  Params:  acc:              accumulator from background_accumulator
+           fgLogLikelihood:  foreground maximum log likelihood
+  '''
+
+  # only show range of bins that are filled
+  edges = acc['binEdges']
+  counts = acc['maxCounts'][1:-1]
+  filled = np.flatnonzero(counts)
+
+  # initialise figure
+  plt.figure(figsize=(8, 6))
+
+  # plot
+  if len(filled) != 0:
+    lo, hi = filled[0], filled[-1] + 1
+    plt.stairs(counts[lo:hi], edges[lo:hi+1], fill=True, color='k')
+  plt.axvline(fgLogLikelihood, color='r')
+
+  # plot configs
+  plt.xlabel('Log likelihood', fontsize=20)
+  plt.ylabel('Number of events', fontsize=20)
+  plt.show()
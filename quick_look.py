@@ -0,0 +1,265 @@
+import time
+import math
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# local imports
+from load_files import numberedSegments
+from likelihood_calculations import prepareSegment
+from time_functions import subsequenceTable, firstPartners
+from coordinate_conversions import greatCircleDistances
+from fast_search import segmentArrays, segmentTimes, pairTemplates, scoreTemplates
+
+# A quick look scores the templates of randomly drawn trigger pairs instead of
+# all pairs of a segment. Pairs are drawn with replacement from the pairs
+# far enough apart in time to produce templates, either uniformly or with the
+# first trigger weighted by the fraction of triggers within distanceWindow of
+# it in latitude, which every pair passing the sky check must be. Totals are
+# estimated by weighting each draw with the inverse of its probability
+# (Hansen-Hurwitz), so both ways of drawing give unbiased estimates.
+
+
+def pairPopulation(triggers, distanceWindow, minSeparation, weighting='uniform'):
+  '''
+  Describes the pairs a quick look draws from.
+
+  Params:     triggers:        dictionary of trigger arrays
+              distanceWindow:  allowed distance uncertainty window
+              minSeparation:   minDelta times the shortest subsequence sum
+
+  Optional:   weighting:       'uniform' or 'sky', see above
+
+  Returns:    population:      dictionary of the first partner and number of
+                               partners of each trigger, the probability of
+                               drawing each trigger first and the total
+                               number of pairs
+  '''
+
+  times, lat = triggers['baryTime'], triggers['lat0']
+  n = len(times)
+  partners = firstPartners(times, minSeparation)
+  counts = n - partners
+
+  weights = counts.astype(float)
+  if weighting == 'sky':
+
+    # fraction of triggers close enough in latitude to pass the sky check
+    sortedLat = np.sort(lat)
+    near = np.searchsorted(sortedLat, lat + distanceWindow, side='right') - np.searchsorted(sortedLat, lat - distanceWindow, side='left')
+    weights *= near / n
+  elif weighting != 'uniform':
+    raise ValueError('Unknown weighting {0}, choose from uniform, sky'.format(weighting))
+
+  total = weights.sum()
+  return {'partners': partners, 'counts': counts,
+          'firstProbability': weights / total if total > 0 else weights,
+          'pairs': int(counts.sum())}
+
+
+def samplePairs(rng, population, size):
+  '''
+  Draws trigger pairs with replacement.
+
+  Returns:  pairI, pairJ:    first and second trigger of each draw
+            probability:     probability of drawing each pair in one draw
+  '''
+
+  p = population['firstProbability']
+  pairI = rng.choice(len(p), size=size, p=p)
+  counts = population['counts'][pairI]
+  pairJ = population['partners'][pairI] + np.floor(rng.random(size) * counts).astype(int)
+
+  return pairI, pairJ, p[pairI] / counts
+
+
+def scorePairs(triggers, pairI, pairJ, distanceWindow, timeWindow, sequence, maxSeq, minDelta, subsequences, totalTime):
+  '''
+  Scores the templates of distinct pairs with the search of the fast engine.
+
+  Returns:  templates:     number of templates of each pair
+            signals:       number of templates with signal candidates
+            maxScores:     largest log likelihood of each pair, -inf for pairs
+                           without templates
+  '''
+
+  nPairs = len(pairI)
+  templates, signals, maxScores = np.zeros(nPairs, dtype=int), np.zeros(nPairs, dtype=int), np.full(nPairs, -np.inf)
+
+  # pairs failing the sky check produce no templates
+  passed = np.flatnonzero(greatCircleDistances(triggers['lat0'][pairI], triggers['long0'][pairI],
+                                               triggers['lat0'][pairJ], triggers['long0'][pairJ]) <= distanceWindow)
+  if len(passed) == 0:
+    return templates, signals, maxScores
+
+  found = pairTemplates(triggers, pairI[passed], pairJ[passed], sequence, maxSeq, minDelta, timeWindow, subsequences)
+  scores, candidates, _ = scoreTemplates(found, triggers, distanceWindow, timeWindow, totalTime)
+
+  # templates come grouped by pair, in the order of the pairs passed on
+  n = len(triggers['baryTime'])
+  owner = passed[np.searchsorted(pairI[passed] * n + pairJ[passed], found['i'] * n + found['j'])]
+  templates += np.bincount(owner, minlength=nPairs)
+  signals += np.bincount(owner, weights=candidates > 0, minlength=nPairs).astype(int)
+  np.maximum.at(maxScores, owner, scores)
+
+  return templates, signals, maxScores
+
+
+def estimateTotal(values, probability):
+  '''
+  Hansen-Hurwitz estimate of a total over all pairs and its standard error.
+  '''
+
+  z = values / probability
+  n = len(z)
+  return z.mean(), (z.std(ddof=1) / math.sqrt(n) if n > 1 else np.inf)
+
+
+def quickLook(dataframe, distanceWindow, timeWindow, sequence, maxSeq, weighting='uniform', seed=0, timeBudget=10.0, targetPrecision=None, confidence=0.95, drawsPerRound=200, maxDraws=None, minDelta=None, prepared=False):
+  '''
+  Approximate search of a segment from randomly drawn trigger pairs.
+
+  Params:     dataframe:        data segment
+              distanceWindow:   allowed distance uncertainty window
+              timeWindow:       allowed time uncertainty
+              sequence:         sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:           max number of steps before sequence restarts
+
+  Optional:   weighting:        'uniform' or 'sky', how pairs are drawn
+              seed:             seed of the random generator
+              timeBudget:       seconds after which drawing stops, None for
+                                no budget
+              targetPrecision:  half width of the candidate rate interval at
+                                which drawing stops, none by default
+              confidence:       confidence level of bounds and intervals
+              drawsPerRound:    number of pairs drawn between checks of the
+                                stopping conditions
+              maxDraws:         largest number of draws, no limit by default
+              minDelta:         minimum sequence unit, one 250th of the
+                                segment duration by default
+              prepared:         boolean, True if the segment has already been
+                                passed through prepareSegment
+
+  Returns:    result:           dictionary with
+                                maxLogLikelihood:  largest log likelihood found
+                                bestPair:          pair of that template
+                                exceedFraction:    bound on the fraction of
+                                         pairs (by drawing probability) with a
+                                         template above maxLogLikelihood
+                                estimatedTemplates, estimatedSignalTemplates:
+                                         estimated totals over all pairs
+                                candidateRate:     estimated fraction of
+                                         templates with signal candidates
+                                candidateRateInterval:  its confidence interval
+                                draws, distinctPairs, pairs, elapsed and
+                                stopReason; once every pair has been drawn
+                                the maximum is that of the full search
+  '''
+
+  start = time.perf_counter()
+  rng = np.random.default_rng(seed)
+
+  df = dataframe if prepared == True else prepareSegment(dataframe)
+  triggers = segmentArrays(df)
+  _, _, totalTime = segmentTimes(triggers)
+  if minDelta is None:
+    minDelta = totalTime / 250
+  subsequences = subsequenceTable(sequence, maxSeq)
+  minSeparation = minDelta * min(entry[2] for entry in subsequences)
+
+  population = pairPopulation(triggers, distanceWindow, minSeparation, weighting=weighting)
+  result = {'maxLogLikelihood': 0, 'bestPair': None, 'pairs': population['pairs'], 'draws': 0,
+            'distinctPairs': 0, 'weighting': weighting, 'seed': seed}
+  if population['pairs'] == 0 or population['firstProbability'].sum() == 0:
+    result.update({'elapsed': time.perf_counter() - start, 'stopReason': 'no pairs'})
+    return result
+
+  # results of every pair scored so far, keyed by pair
+  scored = {}
+  drawable = int(population['counts'][population['firstProbability'] > 0].sum())
+  drawI, drawJ, drawProbability, drawValues = [], [], [], []
+  z = stats.norm.ppf(0.5 + confidence / 2)
+
+  while True:
+    pairI, pairJ, probability = samplePairs(rng, population, drawsPerRound)
+
+    # score pairs not drawn before
+    new = sorted(set(zip(pairI.tolist(), pairJ.tolist())) - scored.keys())
+    if new:
+      newI, newJ = np.array(new).T
+      for pair, values in zip(new, zip(*scorePairs(triggers, newI, newJ, distanceWindow, timeWindow, sequence, maxSeq,
+                                                   minDelta, subsequences, totalTime))):
+        scored[pair] = values
+
+    drawI.append(pairI)
+    drawJ.append(pairJ)
+    drawProbability.append(probability)
+    drawValues.append(np.array([scored[pair] for pair in zip(pairI.tolist(), pairJ.tolist())]))
+
+    # estimates from all draws so far
+    allI, allJ = np.concatenate(drawI), np.concatenate(drawJ)
+    probability, values = np.concatenate(drawProbability), np.concatenate(drawValues)
+    templates, templatesError = estimateTotal(values[:, 0], probability)
+    signals, _ = estimateTotal(values[:, 1], probability)
+
+    # ratio estimate of the candidate rate with a linearised standard error
+    rate = signals / templates if templates > 0 else 0.0
+    residuals = (values[:, 1] - rate * values[:, 0]) / probability
+    rateError = residuals.std(ddof=1) / (math.sqrt(len(residuals)) * templates) if templates > 0 and len(residuals) > 1 else np.inf
+
+    stopReason = None
+    if timeBudget is not None and time.perf_counter() - start >= timeBudget:
+      stopReason = 'time budget'
+    elif targetPrecision is not None and z * rateError <= targetPrecision:
+      stopReason = 'target precision'
+    elif maxDraws is not None and len(allI) >= maxDraws:
+      stopReason = 'maximum draws'
+    elif len(scored) == drawable:
+      stopReason = 'all pairs scored'
+    if stopReason is not None:
+      break
+
+  draws = len(allI)
+  best = int(np.argmax(values[:, 2]))
+
+  # if a fraction f of pairs beat the maximum, all draws miss them with
+  # probability (1-f)^draws, which is below 1-confidence for f above the bound
+  result.update({'maxLogLikelihood': float(values[best, 2]) if np.isfinite(values[best, 2]) else 0,
+                 'bestPair': (int(allI[best]), int(allJ[best])) if np.isfinite(values[best, 2]) else None,
+                 'exceedFraction': 1 - (1 - confidence) ** (1 / draws),
+                 'estimatedTemplates': float(templates), 'estimatedTemplatesError': float(templatesError),
+                 'estimatedSignalTemplates': float(signals),
+                 'candidateRate': float(rate),
+                 'candidateRateInterval': (float(max(0.0, rate - z * rateError)), float(min(1.0, rate + z * rateError))),
+                 'draws': draws, 'distinctPairs': len(scored),
+                 'elapsed': time.perf_counter() - start, 'stopReason': stopReason})
+
+  return result
+
+
+def screenSegments(segments, distanceWindow, timeWindow, sequence, maxSeq, timeBudget=2.0, seed=0, **kwargs):
+  '''
+  Runs a quick look on many segments, e.g. to pick segments for a full run.
+
+  Params:     segments:        list of data segments, or iterable of (segment
+                               number, dataframe)
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   timeBudget:      seconds spent on each segment
+              seed:            seed of the random generator; each segment uses
+                               its own stream derived from it
+              kwargs:          further arguments of quickLook
+
+  Returns:    table:           dataframe with one row of results per segment
+  '''
+
+  rows = []
+  for k, segment in numberedSegments(segments):
+    result = quickLook(segment, distanceWindow, timeWindow, sequence, maxSeq, timeBudget=timeBudget,
+                       seed=[seed, k], **kwargs)
+    rows.append(dict(result, segment=k))
+
+  return pd.DataFrame(rows)
@@ -0,0 +1,212 @@
+import os
+import json
+
+import numpy as np
+
+# Results are kept as one .npy file per column so that they can be memory
+# mapped and filtered without loading everything. Each segment is first
+# written to its own part directory,
+#
+#   storeDir/parts/<segment>/<column>.npy
+#
+# and consolidateResults concatenates all parts into
+#
+#   storeDir/<column>.npy            one entry per template
+#   storeDir/segmentId.npy           one entry per segment
+#   storeDir/segmentMax.npy          one entry per segment
+#   storeDir/index.json              parts included and number of rows
+
+# columns of the array returned by likelihood and the type they are stored as
+COLUMNS = [('score', np.float64), ('i', np.int32), ('j', np.int32),
+           ('templateLength', np.int32), ('candidates', np.int32), ('signal', np.int8)]
+
+# number of rows processed at a time when scanning the store
+CHUNK = 1000000
+
+
+def templateRows(logLikelihoods):
+  '''
+  Array of log likelihoods returned by likelihood with one row per template.
+  likelihood returns a flat array of zeros if no pair passed the checks,
+  which becomes an array without rows.
+  '''
+
+  L = np.asarray(logLikelihoods, dtype=float)
+  if L.ndim != 2:
+    L = np.zeros((0, len(COLUMNS)))
+
+  return L
+
+
+def appendResults(storeDir, segmentId, logLikelihoods, maxLogLikelihood):
+  '''
+  Writes the likelihood results of one segment to the store.
+
+  Params:   storeDir:          directory of result store
+            segmentId:         integer identifying the data segment
+            logLikelihoods:    array of log likelihoods returned by likelihood
+            maxLogLikelihood:  maximum log likelihood of the segment
+  '''
+
+  partDir = os.path.join(storeDir, 'parts', '{0:06d}'.format(segmentId))
+  os.makedirs(partDir, exist_ok=True)
+
+  L = templateRows(logLikelihoods)
+
+  # store each column with its proper type
+  for k, (name, dtype) in enumerate(COLUMNS):
+    np.save(os.path.join(partDir, name + '.npy'), L[:, k].astype(dtype))
+  np.save(os.path.join(partDir, 'segment.npy'), np.array([segmentId, L.shape[0]], dtype=np.int64))
+  np.save(os.path.join(partDir, 'segmentMax.npy'), np.array([maxLogLikelihood], dtype=np.float64))
+
+
+def openColumn(path, dtype, nRows):
+  '''
+  Creates a column file of given length that is filled in place.
+  '''
+
+  # empty files cannot be memory mapped
+  if nRows == 0:
+    np.save(path, np.zeros(0, dtype=dtype))
+    return np.zeros(0, dtype=dtype)
+
+  return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(nRows,))
+
+
+def consolidateResults(storeDir):
+  '''
+  Concatenates all segment parts into single column files. Columns are filled
+  part by part, so memory use does not grow with the size of the store.
+
+  Params:   storeDir:   directory of result store
+  Returns:  index:      dictionary of parts included and number of rows
+  '''
+
+  partsDir = os.path.join(storeDir, 'parts')
+  parts = sorted(os.listdir(partsDir)) if os.path.isdir(partsDir) else []
+
+  # read segment ids and row counts from every part
+  segments = np.array([np.load(os.path.join(partsDir, p, 'segment.npy')) for p in parts], dtype=np.int64).reshape(-1, 2)
+  segmentMax = np.array([np.load(os.path.join(partsDir, p, 'segmentMax.npy'))[0] for p in parts])
+  nRows = int(segments[:, 1].sum())
+
+  # segment column is derived from the row counts
+  segmentColumn = openColumn(os.path.join(storeDir, 'segment.npy'), np.int32, nRows)
+  start = 0
+  for segmentId, n in segments:
+    segmentColumn[start:start+n] = segmentId
+    start += n
+  del segmentColumn
+
+  # copy every other column part by part
+  for name, dtype in COLUMNS:
+    column = openColumn(os.path.join(storeDir, name + '.npy'), dtype, nRows)
+    start = 0
+    for p in parts:
+      values = np.load(os.path.join(partsDir, p, name + '.npy'))
+      column[start:start+len(values)] = values
+      start += len(values)
+    del column
+
+  np.save(os.path.join(storeDir, 'segmentId.npy'), segments[:, 0].astype(np.int32))
+  np.save(os.path.join(storeDir, 'segmentMax.npy'), segmentMax)
+
+  index = {'parts': parts, 'rows': nRows}
+  with open(os.path.join(storeDir, 'index.json'), 'w') as f:
+    json.dump(index, f)
+
+  return index
+
+
+def openResultStore(storeDir):
+  '''
+  Memory maps all columns of a result store, consolidating new parts first.
+
+  Params:   storeDir:   directory of result store
+  Returns:  store:      dictionary of read-only memory mapped columns, with
+                        per-segment maxima under 'segmentId' and 'segmentMax'
+  '''
+
+  # consolidate if parts were added since the last consolidation
+  indexPath = os.path.join(storeDir, 'index.json')
+  partsDir = os.path.join(storeDir, 'parts')
+  parts = sorted(os.listdir(partsDir)) if os.path.isdir(partsDir) else []
+  if not os.path.exists(indexPath):
+    consolidateResults(storeDir)
+  else:
+    with open(indexPath) as f:
+      if json.load(f)['parts'] != parts:
+        consolidateResults(storeDir)
+
+  store = {}
+  for name in ['segment'] + [c[0] for c in COLUMNS]:
+    store[name] = np.load(os.path.join(storeDir, name + '.npy'), mmap_mode='r')
+  store['segmentId'] = np.load(os.path.join(storeDir, 'segmentId.npy'))
+  store['segmentMax'] = np.load(os.path.join(storeDir, 'segmentMax.npy'))
+
+  return store
+
+
+def selectResults(store, minScore=None, maxScore=None, segments=None, signalOnly=False):
+  '''
+  Selects templates by score and segment, scanning the memory mapped columns
+  in chunks so that only the selected rows are loaded.
+
+  Params:     store:        result store opened with openResultStore
+
+  Optional:   minScore:     lowest log likelihood to select
+              maxScore:     highest log likelihood to select
+              segments:     list of segment ids to select
+              signalOnly:   boolean, only select templates with at least one
+                            signal candidate, False by default
+
+  Returns:    selection:    dictionary of selected rows of every column
+  '''
+
+  nRows = len(store['score'])
+  rows = []
+
+  # build mask chunk by chunk
+  for start in range(0, nRows, CHUNK):
+    stop = min(start + CHUNK, nRows)
+    mask = np.ones(stop - start, dtype=bool)
+
+    if minScore is not None:
+      mask &= store['score'][start:stop] >= minScore
+    if maxScore is not None:
+      mask &= store['score'][start:stop] <= maxScore
+    if segments is not None:
+      mask &= np.isin(store['segment'][start:stop], segments)
+    if signalOnly == True:
+      mask &= store['signal'][start:stop] == 1
+
+    rows.append(np.flatnonzero(mask) + start)
+
+  rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+
+  # load selected rows only
+  return {name: np.asarray(store[name][rows]) for name in ['segment'] + [c[0] for c in COLUMNS]}
+
+
+def scoreHistogram(store, bins, segments=None):
+  '''
+  Histograms the log likelihoods of all templates in the store.
+
+  Params:     store:      result store opened with openResultStore
+              bins:       bin edges of histogram
+
+  Optional:   segments:   list of segment ids to include
+
+  Returns:    counts:     number of templates in each bin
+  '''
+
+  counts = np.zeros(len(bins) - 1, dtype=np.int64)
+  nRows = len(store['score'])
+
+  for start in range(0, nRows, CHUNK):
+    scores = store['score'][start:start+CHUNK]
+    if segments is not None:
+      scores = scores[np.isin(store['segment'][start:start+CHUNK], segments)]
+    counts += np.histogram(scores, bins=bins)[0]
+
+  return counts
@@ -0,0 +1,220 @@
+import sys
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+# local imports
+from load_files import numberedSegments
+from likelihood_calculations import prepareSegment
+from fast_search import segmentArrays, searchTriggers
+from result_store import templateRows
+
+# Segments are prepared once in the calling process and their trigger columns
+# are written, one segment after the other, into a single shared memory block
+# of shape (3, total number of triggers) with rows 'baryTime', 'lat0' and
+# 'long0'. Workers attach to the block when they start and take read-only
+# views of it, so a task only names a segment and a range of first triggers:
+#   (k, start, stop)   pairs whose first trigger is start, ..., stop-1 in
+#                      segment k
+COLUMNS = ['baryTime', 'lat0', 'long0']
+
+
+def shareSegments(segments, prepared=False):
+  '''
+  Publishes the trigger columns of many segments in shared memory.
+
+  Params:     segments:     list of data segments, or iterable of (segment
+                            number, dataframe)
+
+  Optional:   prepared:     boolean, True if segments have already been passed
+                            through prepareSegment, False by default
+
+  Returns:    memory:       SharedMemory object, to be closed and unlinked by
+                            the caller once all workers are done
+              descriptor:   dictionary of the shared memory name, the offset
+                            of each segment's first trigger and the segment
+                            numbers, which is all a worker needs to attach
+  '''
+
+  numbers, arrays = [], []
+  for k, segment in numberedSegments(segments):
+    df = segment if prepared == True else prepareSegment(segment)
+    numbers.append(k)
+    arrays.append(segmentArrays(df))
+
+  offsets = np.cumsum([0] + [len(a['baryTime']) for a in arrays]).astype(np.int64)
+
+  # one block holding all columns; shared memory cannot be empty
+  memory = shared_memory.SharedMemory(create=True, size=max(1, 8 * len(COLUMNS) * int(offsets[-1])))
+  block = np.ndarray((len(COLUMNS), offsets[-1]), dtype=float, buffer=memory.buf)
+  for row, key in enumerate(COLUMNS):
+    for a, start in zip(arrays, offsets):
+      block[row, start:start + len(a[key])] = a[key]
+  del block
+
+  return memory, {'name': memory.name, 'offsets': offsets, 'numbers': numbers}
+
+
+def attachSegments(descriptor):
+  '''
+  Attaches to segments published by shareSegments.
+
+  Returns:  memory:   SharedMemory object, to be closed (not unlinked) when done
+            block:    read-only array view of the trigger columns
+  '''
+
+  # attaching processes must not remove the block when they exit
+  if sys.version_info >= (3, 13):
+    memory = shared_memory.SharedMemory(name=descriptor['name'], track=False)
+  else:
+    memory = shared_memory.SharedMemory(name=descriptor['name'])
+
+  block = np.ndarray((len(COLUMNS), descriptor['offsets'][-1]), dtype=float, buffer=memory.buf)
+  block.flags.writeable = False
+
+  return memory, block
+
+
+def segmentTriggers(block, offsets, k):
+  '''
+  Trigger arrays of the kth published segment, as views of the shared block.
+  '''
+
+  return {key: block[row, offsets[k]:offsets[k+1]] for row, key in enumerate(COLUMNS)}
+
+
+def planTasks(offsets, pairBlock=None):
+  '''
+  Splits the search of published segments into tasks.
+
+  Params:     offsets:      offsets of segments in the shared block
+
+  Optional:   pairBlock:    approximate number of trigger pairs per task;
+                            segments with more pairs are split into ranges of
+                            first triggers, by default one task per segment
+
+  Returns:    tasks:        list of (k, start, stop) task descriptors
+  '''
+
+  tasks = []
+  for k, n in enumerate(np.diff(offsets)):
+    n = int(n)
+
+    if pairBlock is None or n * (n - 1) // 2 <= pairBlock:
+      tasks.append((k, 0, n))
+      continue
+
+    # trigger i is the first trigger of at most n-1-i pairs
+    pairs = np.cumsum(np.arange(n - 1, -1, -1))
+    edges = np.searchsorted(pairs, np.arange(pairBlock, pairs[-1], pairBlock), side='right')
+    edges = np.unique(np.concatenate([[0], edges, [n]]))
+    tasks.extend((k, int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]))
+
+  return tasks
+
+
+# shared block and search settings held by each worker process
+workerState = {}
+
+
+def attachWorker(descriptor, settings):
+  '''
+  Initialises a worker process with the shared segments and search settings.
+  '''
+
+  workerState['memory'], workerState['block'] = attachSegments(descriptor)
+  workerState['offsets'] = descriptor['offsets']
+  workerState['settings'] = settings
+
+
+def detachWorker():
+  '''
+  Releases the shared segments held by the current process.
+  '''
+
+  # views must be dropped before the memory can be closed
+  memory = workerState.pop('memory')
+  workerState.clear()
+  memory.close()
+
+
+def searchTask(task):
+  '''
+  Searches the pairs of one task in a worker process.
+
+  Returns:  k, start:   task position, to put partial results in order
+            L, maxL:    results of searchTriggers for the task's pairs
+  '''
+
+  k, start, stop = task
+  triggers = segmentTriggers(workerState['block'], workerState['offsets'], k)
+  L, maxL = searchTriggers(triggers, firstTriggers=range(start, min(stop, len(triggers['baryTime']) - 1)),
+                           **workerState['settings'])
+
+  return k, start, L, maxL
+
+
+def combinePartials(partials):
+  '''
+  Joins the results of consecutive tasks of one segment into the results of
+  likelihood for the whole segment.
+  '''
+
+  found = [(templateRows(L), maxL) for L, maxL in partials]
+  found = [(L, maxL) for L, maxL in found if len(L) > 0]
+  if not found:
+    return np.zeros(6), 0
+
+  return np.concatenate([L for L, _ in found]), max(maxL for _, maxL in found)
+
+
+def runShared(segments, distanceWindow, timeWindow, sequence, maxSeq, nWorkers=2, pairBlock=None, prepared=False, **kwargs):
+  '''
+  Searches many segments in worker processes that read trigger arrays from
+  shared memory instead of receiving dataframes. Results are those of the
+  fast engine.
+
+  Params:     segments:        list of data segments, or iterable of (segment
+                               number, dataframe)
+              distanceWindow:  allowed distance uncertainty window
+              timeWindow:      allowed time uncertainty
+              sequence:        sequence function (e.g.: primes, Fibonacci, ...)
+              maxSeq:          max number of steps before sequence restarts
+
+  Optional:   nWorkers:        number of worker processes
+              pairBlock:       approximate number of trigger pairs per task,
+                               see planTasks
+              prepared:        boolean, True if segments have already been
+                               passed through prepareSegment, False by default
+              kwargs:          further arguments of searchTriggers, e.g.
+                               minDelta or maxTemplateLength
+
+  Returns:    results:         list of (segment number, L, maxL), in the order
+                               of segments
+  '''
+
+  settings = dict(kwargs, distanceWindow=distanceWindow, timeWindow=timeWindow, sequence=sequence, maxSeq=maxSeq)
+  memory, descriptor = shareSegments(segments, prepared=prepared)
+  tasks = planTasks(descriptor['offsets'], pairBlock=pairBlock)
+
+  try:
+    if nWorkers == 1:
+      attachWorker(descriptor, settings)
+      try:
+        partials = [searchTask(task) for task in tasks]
+      finally:
+        detachWorker()
+    else:
+      with ProcessPoolExecutor(max_workers=nWorkers, initializer=attachWorker, initargs=(descriptor, settings)) as pool:
+        partials = list(pool.map(searchTask, tasks))
+
+  finally:
+    memory.close()
+    memory.unlink()
+
+  # join partial results of each segment, tasks come in order of first trigger
+  bySegment = [[] for _ in descriptor['numbers']]
+  for k, start, L, maxL in sorted(partials, key=lambda p: (p[0], p[1])):
+    bySegment[k].append((L, maxL))
+
+  return [(number,) + combinePartials(partial) for number, partial in zip(descriptor['numbers'], bySegment)]
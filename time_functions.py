@@ -4,7 +4,57 @@ import numpy as np
 from uncertainty_windows import windows
 
 
-def timeLocations(trigger1Time, trigger2Time, minTime, maxTime, sequence, maxSeq, minDelta, timeWindow, plot=False, verbose=False):
+def subsequenceTable(sequence, maxSeq):
+  '''
+  Lists every subsequence that can join a trigger pair, in the order they are
+  tried in timeLocations.
+
+  Params:   sequence:   sequence function (e.g.: primes, Fibonacci, ...)
+            maxSeq:     maximum number of times in sequence, after which
+                        the sequence restarts
+
+  Returns:  table:      list of (i, j, sum) with sequence locations i and j of
+                        the two triggers and the sum of the subsequence
+                        joining them
+  '''
+
+  return [(i, j, sum(sequence(i, j))) for i in range(1, maxSeq+1) for j in range(i, maxSeq+1)]
+
+
+def admissibleSubsequences(table, step, minDelta):
+  '''
+  Selects the subsequences whose sequence unit is above minDelta for a given
+  time separation of a trigger pair.
+
+  Params:   table:       subsequence table from subsequenceTable
+            step:        time separation of trigger pair
+            minDelta:    minimum value of the time unit
+
+  Returns:  admissible:  entries of table that produce a template
+  '''
+
+  # same comparison as in timeLocations so that no template is lost
+  return [entry for entry in table if step / entry[2] > minDelta]
+
+
+def firstPartners(times, minSeparation):
+  '''
+  Finds for each trigger the first later trigger that is more than
+  minSeparation away, lowered by a few rounding errors so that no pair
+  producing templates is missed; timeLocations does the exact comparison.
+
+  Params:   times:           sorted trigger times
+            minSeparation:   minDelta times the shortest subsequence sum
+
+  Returns:  partners:        index of first partner of each trigger, the
+                             number of triggers if there is none
+  '''
+
+  partners = np.searchsorted(times, times + minSeparation * (1 - 1e-9) - 4 * np.spacing(times), side='right')
+  return np.maximum(partners, np.arange(1, len(times) + 1))
+
+
+def timeLocations(trigger1Time, trigger2Time, minTime, maxTime, sequence, maxSeq, minDelta, timeWindow, maxLength=None, subsequences=None, plot=False, verbose=False):
   '''
   Finds locations of time points that need to be checked.
 
@@ -21,7 +71,13 @@ def timeLocations(trigger1Time, trigger2Time, minTime, maxTime, sequence, maxSeq
                               reasonable lengths of each trigger sequence
               timeWindow:     uncertainty window around times
 
-  Optional:   plot:             boolean, determines if lists necessary for plots
+  Optional:   maxLength:      maximum number of time locations outside the
+                              trigger pair, the ones furthest from the pair are
+                              dropped, no limit by default
+              subsequences:   list of (i, j, sum) subsequences to try, from
+                              subsequenceTable or admissibleSubsequences, all
+                              subsequences up to maxSeq by default
+              plot:             boolean, determines if lists necessary for plots
                                 need to be filled, False by default
 
   Returns:    timeLocs:       two dimensional list containing time locations
@@ -41,51 +97,57 @@ def timeLocations(trigger1Time, trigger2Time, minTime, maxTime, sequence, maxSeq
   if plot == True:
     sequenceLocs = []
 
+  # find subsequences joining the two triggers
+  if subsequences is None:
+    subsequences = subsequenceTable(sequence, maxSeq)
+
   # loop over possible sequence steps
-  for i in range(1, maxSeq+1):
-    for j in range(i, maxSeq+1):
+  for i, j, seqSum in subsequences:
 
-      # find subsequence joining the two triggers
-      seq = sequence(i, j)
+    # define delta as one sequence unit (e.g., the number 2 in a sequence
+    # would be marked as 2 * delta)
+    delta = step / seqSum
 
-      # define delta as one sequence unit (e.g., the number 2 in a sequence
-      # would be marked as 2 * delta)
-      delta = step / sum(seq)
+    # check if delta is within allowed bounds
+    if delta > minDelta:
 
-      # check if delta is within allowed bounds
-      if delta > minDelta:
+      # generate list of time values forwards in sequence
+      forwardSequence, forwardLocs = locForward(delta, j, sequence, maxSeq,
+                                      trigger2Time, maxTime, plot=plot)
 
-        # generate list of time values forwards in sequence
-        forwardSequence, forwardLocs = locForward(delta, j, sequence, maxSeq,
-                                        trigger2Time, maxTime, plot=plot)
+      # generate list of time values backwards in sequence
+      backwardSequence, backwardLocs = locBackward(delta, i, sequence, maxSeq,
+                                        minTime, trigger1Time, plot=plot)
 
-        # generate list of time values backwards in sequence
-        backwardSequence, backwardLocs = locBackward(delta, i, sequence, maxSeq,
-                                          minTime, trigger1Time, plot=plot)
+      # generate list of time values between two initial triggers
+      midSequence, midLocs = locBetween(delta, i, j, sequence, maxSeq,
+                              trigger1Time, trigger2Time, plot=plot)
 
-        # generate list of time values between two initial triggers
-        midSequence, midLocs = locBetween(delta, i, j, sequence, maxSeq,
-                                trigger1Time, trigger2Time, plot=plot)
+      # only keep the time values closest to the trigger pair, if prompted
+      if maxLength is not None:
+        backwardSequence, backwardLocs, forwardSequence, forwardLocs = capLength(
+          backwardSequence, backwardLocs, forwardSequence, forwardLocs,
+          trigger1Time, trigger2Time, maxLength, plot=plot)
 
-        # concatenate lists
-        fullSequence = backwardSequence + midSequence + forwardSequence
-        if plot == True:
-          fullLocs = backwardLocs + midLocs + forwardLocs
+      # concatenate lists
+      fullSequence = backwardSequence + midSequence + forwardSequence
+      if plot == True:
+        fullLocs = backwardLocs + midLocs + forwardLocs
 
-        # calculate uncertainty windows for the full sequence
-        fullWindow = windows(trigger1Time, trigger2Time, fullSequence, timeWindow, delta)
+      # calculate uncertainty windows for the full sequence
+      fullWindow = windows(trigger1Time, trigger2Time, fullSequence, timeWindow, delta)
 
-        # add sequence and window to list of sequence lists to be tested
-        if len(fullSequence) != 0:
-          timeLocs.append(fullSequence)
-          timeWindows.append(fullWindow)
-          if plot == True:
-            sequenceLocs.append(fullLocs)
+      # add sequence and window to list of sequence lists to be tested
+      if len(fullSequence) != 0:
+        timeLocs.append(fullSequence)
+        timeWindows.append(fullWindow)
+        if plot == True:
+          sequenceLocs.append(fullLocs)
 
-      # sanity check for smaller deltas
-      else:
-        if verbose == True:
-          print('Delta too small:', delta)
+    # sanity check for smaller deltas
+    else:
+      if verbose == True:
+        print('Delta too small:', delta)
 
   # add sequence location list to returns if needed for plotting
   if plot == True:
@@ -96,6 +158,49 @@ def timeLocations(trigger1Time, trigger2Time, minTime, maxTime, sequence, maxSeq
   return timeLocs, timeWindows, list()
 
 
+def capLength(backwardSequence, backwardLocs, forwardSequence, forwardLocs, trigger1Time, trigger2Time, maxLength, plot=False):
+  '''
+  Shortens the parts of a sequence outside the trigger pair so that at most
+  maxLength time locations remain, dropping those furthest from the pair.
+
+  Params:     backwardSequence:  time locations before first trigger
+              backwardLocs:      sequence numbers of backward locations
+              forwardSequence:   time locations after second trigger
+              forwardLocs:       sequence numbers of forward locations
+              trigger1Time:      time of first trigger in pair
+              trigger2Time:      time of second trigger in pair
+              maxLength:         maximum number of locations to keep
+
+  Optional:   plot:              boolean, determines if sequence numbers need
+                                 to be shortened as well, False by default
+
+  Returns:    backwardSequence, backwardLocs, forwardSequence, forwardLocs:
+                                 shortened lists
+  '''
+
+  if len(backwardSequence) + len(forwardSequence) <= maxLength:
+    return backwardSequence, backwardLocs, forwardSequence, forwardLocs
+
+  # distances of all locations to the trigger pair, backward locations are
+  # ordered chronologically so the nearest one is last
+  distances = sorted([(trigger1Time - t, 0) for t in backwardSequence] +
+                     [(t - trigger2Time, 1) for t in forwardSequence])[:maxLength]
+
+  # number of locations kept on each side
+  nBackward = sum(1 for d in distances if d[1] == 0)
+  nForward = len(distances) - nBackward
+
+  backwardSequence = backwardSequence[len(backwardSequence)-nBackward:]
+  forwardSequence = forwardSequence[:nForward]
+
+  # sequence numbers include one entry beyond the last forward location
+  if plot == True:
+    backwardLocs = backwardLocs[len(backwardLocs)-nBackward:]
+    forwardLocs = forwardLocs[:nForward+1]
+
+  return backwardSequence, backwardLocs, forwardSequence, forwardLocs
+
+
 def locForward(delta, loc2, sequence, maxSeq, trigger2Time, maxTime, plot=False):
   '''
   Finds locations of time points forward in sequence that need to be checked.
@@ -1,8 +1,10 @@
 import math
+import numpy as np
 from scipy import stats
 
 # local imports
 from similarity_checks import similarityParams, similarityDistance
+from coordinate_conversions import greatCircleDistances
 
 
 def search(logLikelihoodStart, totalTime, triggers, sequenceTimes, timeWindows, midDist, distanceWindow, params=None, paramMidpoints=None, paramWindows=None, verbose=False):
@@ -93,4 +95,153 @@ def search(logLikelihoodStart, totalTime, triggers, sequenceTimes, timeWindows,
           logLikelihood += gaussianStatistic + math.log(totalTime)
 
   # otherwise, return log likelihood value
-  return logLikelihood, signalCandidates
\ No newline at end of file
+  return logLikelihood, signalCandidates
+
+
+def nearestTriggers(triggerTimes, sequenceTimes):
+  '''
+  Finds the closest trigger to each time location at once, picking the
+  earliest trigger on ties like search does.
+
+  Params:   triggerTimes:   sorted barycentre times of all triggers
+            sequenceTimes:  array of time locations
+
+  Returns:  nearest:        index of closest trigger for each time location
+  '''
+
+  sequenceTimes = np.asarray(sequenceTimes, dtype=float)
+  n = len(triggerTimes)
+
+  # closest triggers before and after each location
+  after = np.searchsorted(triggerTimes, sequenceTimes, side='left')
+  before = np.clip(after - 1, 0, n - 1)
+  after = np.clip(after, 0, n - 1)
+
+  # take earlier trigger unless the later one is strictly closer; of several
+  # triggers at the same time the first one is taken
+  useBefore = np.abs(triggerTimes[before] - sequenceTimes) <= np.abs(triggerTimes[after] - sequenceTimes)
+  before = np.searchsorted(triggerTimes, triggerTimes[before], side='left')
+
+  return np.where(useBefore, before, after)
+
+
+def pointStatistics(totalTime, triggers, sequenceTimes, timeWindows, midLat, midLong, distanceWindow, nearest=None):
+  '''
+  Evaluates the contribution of each time location to the log likelihood of
+  its sequence, as search does one location at a time. Locations of several
+  sequences can be evaluated together by passing one midpoint per location.
+
+  Params:     totalTime:       full time range of data segment
+              triggers:        dictionary of 'baryTime', 'lat0' and 'long0'
+                               arrays of all triggers, sorted by time
+              sequenceTimes:   array of time locations
+              timeWindows:     array of uncertainty windows around the times
+              midLat, midLong: coordinates of midpoint between initial
+                               trigger pair, single values or one per location
+              distanceWindow:  allowed distance uncertainty window
+
+  Optional:   nearest:         index of closest trigger to each location, if
+                               already known
+
+  Returns:    contributions:   log likelihood added by each location, zero
+                               where no signal candidate is found
+              candidate:       boolean array, True where a signal candidate
+                               is found
+              nearest:         index of closest trigger to each location
+  '''
+
+  if nearest is None:
+    nearest = nearestTriggers(triggers['baryTime'], sequenceTimes)
+
+  # check distance similarity with original triggers
+  distances = greatCircleDistances(triggers['lat0'][nearest], triggers['long0'][nearest], midLat, midLong)
+
+  # evaluate Gaussian at time location of closest trigger
+  gaussianStatistic = stats.norm.logpdf(triggers['baryTime'][nearest], loc=sequenceTimes, scale=timeWindows)
+
+  # signal candidates pass the distance check and beat the background value
+  logTotalTime = math.log(totalTime)
+  candidate = (distances <= distanceWindow) & (gaussianStatistic > - logTotalTime)
+
+  return np.where(candidate, gaussianStatistic + logTotalTime, 0.0), candidate, nearest
+
+
+def occupancyMap(triggers, binWidth, bandWidth=None):
+  '''
+  Counts triggers in bins of time and, optionally, latitude. Counts are kept
+  as cumulative sums over both, so the number of triggers in any block of
+  bins is found from four entries.
+
+  Params:     triggers:    dictionary of 'baryTime' and 'lat0' arrays
+              binWidth:    width of time bins in seconds, e.g. timeWindow
+
+  Optional:   bandWidth:   width of latitude bands in degrees, a single band
+                           by default
+
+  Returns:    occupancy:   dictionary of cumulative counts and binning
+  '''
+
+  times, lat = triggers['baryTime'], triggers['lat0']
+  minTime = times.min()
+  nBins = int((times.max() - minTime) // binWidth) + 1
+  nBands = 1 if bandWidth is None else int(math.ceil(180 / bandWidth))
+
+  timeBin = ((times - minTime) // binWidth).astype(int)
+  band = np.zeros(len(times), dtype=int)
+  if bandWidth is not None:
+    band = np.clip(((lat + 90) // bandWidth).astype(int), 0, nBands - 1)
+
+  counts = np.zeros((nBands, nBins), dtype=np.int64)
+  np.add.at(counts, (band, timeBin), 1)
+  cumulative = np.zeros((nBands + 1, nBins + 1), dtype=np.int64)
+  cumulative[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+  return {'cumulative': cumulative, 'minTime': minTime, 'binWidth': binWidth,
+          'bandWidth': bandWidth, 'nBins': nBins, 'nBands': nBands}
+
+
+def hitReach(timeWindows, totalTime):
+  '''
+  Largest distance of a trigger from a time location at which its Gaussian
+  statistic still beats the background value -log(totalTime), slightly
+  widened against rounding errors.
+  '''
+
+  logPeak = np.log(timeWindows * math.sqrt(2 * math.pi))
+  reach = timeWindows * np.sqrt(np.maximum(0, 2 * (math.log(totalTime) - logPeak)))
+
+  return reach * (1 + 1e-9) + 1e-6
+
+
+def reachableTriggers(occupancy, pointTime, reach, midLat, distanceWindow):
+  '''
+  Counts triggers in the occupancy bins within reach of each time location
+  and, with latitude bands, within distanceWindow in latitude of the
+  midpoint. The count is zero wherever the location cannot find a signal
+  candidate, as its closest trigger would have to be one of them.
+
+  Params:   occupancy:        occupancy map from occupancyMap
+            pointTime:        array of time locations
+            reach:            array of reaches from hitReach
+            midLat:           latitude of the pair midpoint of each location
+            distanceWindow:   allowed distance uncertainty window
+
+  Returns:  array of trigger counts, one per time location
+  '''
+
+  cumulative, binWidth = occupancy['cumulative'], occupancy['binWidth']
+  nBins, nBands = occupancy['nBins'], occupancy['nBands']
+
+  # time bins overlapping the reach, as a half-open range
+  first = np.clip(np.floor((pointTime - reach - occupancy['minTime']) / binWidth), 0, nBins).astype(int)
+  last = np.clip(np.floor((pointTime + reach - occupancy['minTime']) / binWidth) + 1, 0, nBins).astype(int)
+
+  # latitude bands overlapping the sky check
+  if occupancy['bandWidth'] is None:
+    low, high = np.zeros(len(pointTime), dtype=int), np.ones(len(pointTime), dtype=int)
+  else:
+    bandWidth = occupancy['bandWidth']
+    low = np.clip(np.floor((midLat - distanceWindow + 90) / bandWidth), 0, nBands).astype(int)
+    high = np.clip(np.floor((midLat + distanceWindow + 90) / bandWidth) + 1, 0, nBands).astype(int)
+
+  return cumulative[high, last] - cumulative[low, last] - cumulative[high, first] + cumulative[low, first]